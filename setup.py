@@ -7,7 +7,7 @@ Setup for XML helper
 
 from distutils.core import setup
 setup(name="xmlhelper",
-      version="0.23.0",
+      version="0.24.0",
       author="Clemens Radl",
       author_email="clemens.radl@googlemail.com",
       url="http://www.clemens-radl.de/soft/xmlhelper/",
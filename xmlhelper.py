@@ -10,14 +10,20 @@ try:
     from builtins import str as unitext  # python 2/3
 except ImportError:  # pragma: no cover
     unitext = unicode
+from bisect import bisect_right
+from collections import OrderedDict
 from copy import deepcopy
 from doctest import Example
+from io import BytesIO, open as io_open
+import os
+import traceback
 import unittest
+from weakref import WeakValueDictionary
 
 from lxml import etree as et
 from lxml.doctestcompare import LXMLOutputChecker
 
-__version__ = "0.23.0"
+__version__ = "0.24.0"
 __author__ = "Clemens Radl <clemens.radl@googlemail.com>"
 
 TEXT = 1
@@ -159,11 +165,11 @@ class PrecedingIterator(object):
         self.start_element = element
         self.current_element = element
         self.b_done = False
-        # establish list of ancestors
-        self.ancestors = []
+        # establish set of ancestors
+        self.ancestors = set()
         ancestor = element.getparent()
         while ancestor is not None:
-            self.ancestors.append(ancestor)
+            self.ancestors.add(ancestor)
             ancestor = ancestor.getparent()
         if len(self.ancestors) == 0:
             # We initialized with the root element.
@@ -184,33 +190,24 @@ class PrecedingIterator(object):
         """
         if self.b_done:
             raise StopIteration
-        prv = self.current_element.getprevious()
-        if prv is not None:
-            # dive into the element
-            if len(prv) == 0:
+        while 1:
+            prv = self.current_element.getprevious()
+            if prv is not None:
+                # dive into the element
+                while len(prv) > 0:
+                    prv = prv[-1]
                 self.current_element = prv
                 return prv
-            while len(prv) > 0:
-                prv = prv[-1]
-            self.current_element = prv
-            return prv
-        else:
             # no previous element found
             parent = self.current_element.getparent()
             if parent is None:
                 self.b_done = True
                 raise StopIteration
+            self.current_element = parent
             if parent not in self.ancestors:
-                self.current_element = parent
                 return parent
-            else:
-                # We may not use this element,
-                # as it is in the ancestors list,
-                # but we just set it as the current
-                # element and move on without returning
-                # anything.
-                self.current_element = parent
-                return self.next()
+            # We may not use this element, as it is an
+            # ancestor, so we move on without returning it.
 
 class AllChildNodesIterator(object):
     """Iterator over all children of an element (including TextNodes)"""
@@ -252,7 +249,13 @@ class PrecedingNodesIterator(object):
     def __init__(self, node):
         self.start_node = node
         self.current_node = node
- 
+        # the ancestors are not part of the preceding axis
+        self.ancestors = set()
+        ancestor = node.getparent()
+        while ancestor is not None:
+            self.ancestors.add(ancestor)
+            ancestor = ancestor.getparent()
+
     def __iter__(self):
         return self
 
@@ -290,7 +293,9 @@ class PrecedingNodesIterator(object):
             node = self._get_previous_node(node)
             if node is None:
                 break
-            if not contains(node, self.start_node):
+            # only elements reached from their first text node
+            # can be ancestors
+            if isinstance(node, TextNode) or node not in self.ancestors:
                 self.current_node = node
                 return node
         self.b_done = True
@@ -346,15 +351,21 @@ class FollowingNodesIterator(object):
 class TextNode(object):
     """A simple node type to represent text that "knows"
     about its position in the document
+
+    TextNodes are identified by their position: two TextNodes are
+    equal if they have the same parent and the same previous element
+    (see ``key``), regardless of their text.
     """
 
-    text = ""
-    parent = None
-    # the element this is a tail of,
-    # if None, then it's text of the parent
-    previous = None
-    # if text node is empty
-    empty = False
+    # text: the text ("" if empty)
+    # parent: the parent element
+    # previous: the element this is a tail of,
+    #   if None, then it's text of the parent
+    # empty: if text node is empty
+    __slots__ = ("text", "parent", "previous", "empty", "__weakref__")
+
+    # key -> TextNode, see ``intern``
+    _interned = WeakValueDictionary()
 
     def __init__(self, text, parent, previous=None):
         """Initialize"""
@@ -363,9 +374,43 @@ class TextNode(object):
             self.empty = True
         else:
             self.text = text
+            self.empty = False
         self.parent = parent
         self.previous = previous
 
+    @classmethod
+    def intern(cls, text, parent, previous=None):
+        """Return the TextNode for this position
+
+        As long as a TextNode for the position exists, the same
+        instance is returned (with the text updated to ``text``).
+        """
+        key = (parent, TEXT) if previous is None else (previous, TAIL)
+        ret = cls._interned.get(key)
+        if ret is None:
+            ret = cls._interned[key] = cls(text, parent, previous)
+        elif text is None:
+            ret.text = ""
+            ret.empty = True
+        else:
+            ret.text = text
+            ret.empty = False
+        return ret
+
+    @property
+    def text_or_tail(self):
+        """``TEXT`` or ``TAIL``"""
+        return TEXT if self.previous is None else TAIL
+
+    @property
+    def key(self):
+        """Position as ``(element, text_or_tail)`` (as in
+        ``get_t_struct``)
+        """
+        if self.previous is None:
+            return (self.parent, TEXT)
+        return (self.previous, TAIL)
+
     def getparent(self):
         return self.parent
 
@@ -385,15 +430,14 @@ class TextNode(object):
     def __eq__(self, other):
         if not isinstance(other, TextNode):
             return False
-        return (self.text == other.text
-                and self.parent == other.parent
-                and self.previous == other.previous)
+        return (self.parent is other.parent
+                and self.previous is other.previous)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return (self.text, self.parent, self.previous).__hash__()
+        return hash(self.key)
 
     def __len__(self):
         return len(self.text)
@@ -404,14 +448,901 @@ class TextNode(object):
     def __str__(self):
         return self.text
 
+class SkipSpec(object):
+    """Compiled specification of the elements to skip
+
+    The functions accepting ``skip_els`` (``get_text``, ``goto``,
+    ``get_t_struct``, ``count_characters``, ``get_pos``, ``rstrip``,
+    ``lstrip``, ``goto_next_char``, the text offset indexes etc.)
+    normalize it on every call and then look up the tag of each node
+    in it. If you call them often with the same (long) list of tags,
+    compile it once and pass the ``SkipSpec`` instead::
+
+        spec = SkipSpec(["note", "{*}fw", "{%s}*" % ns["xml"]],
+                        repl=["*"])
+        get_text(el, spec)
+
+    ``skip_els`` is a list of tags (or a single tag). ``"*"`` skips
+    all elements. Besides plain tags you can use ``"{*}local"``
+    (``local`` in any or no namespace) and ``"{uri}*"`` (all elements
+    in namespace ``uri``). ``repl`` are the replacement strings for
+    the skipped elements in ``get_text``, in the same order as the
+    tags (missing ones are ``""``).
+
+    Comments and processing instructions never contribute text. If
+    you set ``skip_comments`` or ``skip_pis`` to ``False``, their
+    content is treated as text, too (you cannot insert elements into
+    them, though).
+    """
+
+    skip_all = False
+    skip_comments = True
+    skip_pis = True
+    # true if nothing is skipped besides comments and PIs
+    empty = False
+
+    def __init__(self, skip_els=[], repl=[], skip_comments=True,
+                 skip_pis=True):
+        """Initialize"""
+        if skip_els == "*":
+            self.skip_all = True
+            skip_els = ["*"]
+        elif not isinstance(skip_els, (list, tuple, set, frozenset)):
+            skip_els = [skip_els]
+        if not isinstance(repl, (list, tuple)):
+            repl = [repl]
+        tags = set()
+        # tag -> replacement, the first occurrence wins
+        self.repl = {}
+        # (uri, local, replacement)
+        self._wildcards = []
+        for (i, tag) in enumerate(skip_els):
+            txt = repl[i] if i < len(repl) else ""
+            if (not self.skip_all and isinstance(tag, (str, unitext)) and
+                    (tag.startswith("{*}") or tag.endswith("}*"))):
+                uri, local = tag[1:].split("}", 1)
+                self._wildcards.append((uri, local, txt))
+            else:
+                tags.add(tag)
+                self.repl.setdefault(tag, txt)
+        self.tags = frozenset(tags)
+        self._args = ("*" if self.skip_all else tuple(skip_els),
+                      skip_comments, skip_pis)
+        self.all_repl = repl[0] if repl else ""
+        self.skip_comments = skip_comments
+        self.skip_pis = skip_pis
+        self.empty = (not self.skip_all and not self.tags and
+                      not self._wildcards and skip_comments and skip_pis)
+        # tag -> replacement (or None) of the matching wildcard
+        self._cache = {}
+        self._without_replacements = None
+
+    def __repr__(self):
+        if self.skip_all:
+            return u"{}('*')".format(self.__class__.__name__)
+        tags = sorted(unitext(tag) for tag in self.tags) + \
+               [u"{%s}%s" % (uri, local)
+                for (uri, local, txt) in self._wildcards]
+        return u"{}({})".format(self.__class__.__name__, tags)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def without_replacements(self):
+        """Return the same ``SkipSpec``, but without replacements"""
+        if self._without_replacements is None:
+            if (self.all_repl or any(self.repl.values()) or
+                    any(txt for (uri, local, txt) in self._wildcards)):
+                (skip_els, skip_comments, skip_pis) = self._args
+                self._without_replacements = self.__class__(
+                    skip_els, skip_comments=skip_comments,
+                    skip_pis=skip_pis)
+            else:
+                self._without_replacements = self
+        return self._without_replacements
+
+    def _match_wildcards(self, tag):
+        """Return replacement of the wildcard matching ``tag`` or None"""
+        try:
+            return self._cache[tag]
+        except KeyError:
+            pass
+        ret = None
+        if isinstance(tag, (str, unitext)):
+            if tag.startswith("{"):
+                uri, local = tag[1:].split("}", 1)
+            else:
+                uri, local = "", tag
+            for (p_uri, p_local, txt) in self._wildcards:
+                if ((p_uri == "*" or p_uri == uri) and
+                        (p_local == "*" or p_local == local)):
+                    ret = txt
+                    break
+        self._cache[tag] = ret
+        return ret
+
+    def matches(self, tag):
+        """Is ``tag`` one of the tags to skip?"""
+        if self.skip_all or tag in self.tags:
+            return True
+        if self._wildcards:
+            return self._match_wildcards(tag) is not None
+        return False
+
+    def ignores(self, node):
+        """Is the content of ``node`` skipped?
+
+        This is true for the elements to skip and (by default) for
+        comments and processing instructions.
+        """
+        tag = node.tag
+        if self.skip_all or tag in self.tags:
+            return True
+        if tag == et.Comment:
+            return self.skip_comments
+        if tag == et.ProcessingInstruction:
+            return self.skip_pis
+        if self._wildcards:
+            return self._match_wildcards(tag) is not None
+        return False
+
+    def replacement(self, node):
+        """Return the replacement string for the skipped ``node``"""
+        if self.skip_all:
+            return self.all_repl
+        tag = node.tag
+        try:
+            return self.repl[tag]
+        except KeyError:
+            pass
+        if self._wildcards:
+            return self._match_wildcards(tag) or ""
+        return ""
+
+class TextOffsetIndex(object):
+    """Character offset index for the text content of an element
+
+    The index walks ``get_t_struct`` once and keeps a sorted array
+    of the offsets at which the text and tail segments start. Thus
+    it can answer the questions of ``goto`` (position to element) by
+    binary search and the questions of ``get_pos`` (element to
+    position) by a dictionary lookup, without walking the element
+    again and again.
+
+    The index reflects the element as it was when the index was
+    built. If you change the element yourself, call ``rebuild``.
+    If you pass the index to one of the functions changing the
+    tree (``insert_at``, ``delete``, ``wrap`` etc.), it is rebuilt
+    automatically on the next lookup. If you need to interleave many
+    lookups and changes, use ``DynamicTextOffsetIndex`` instead.
+    """
+
+    element = None
+    skip_els = None
+    _stale = False
+
+    def __init__(self, element, skip_els=[]):
+        """Build the index for ``element``"""
+        self.element = element
+        self.skip_els = get_skip_spec(skip_els)
+        self.rebuild()
+
+    def __repr__(self):
+        return u"{}({})".format(self.__class__.__name__, self.element)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __len__(self):
+        """Return number of characters in the indexed element"""
+        if self._stale:
+            self.rebuild()
+        return self._length
+
+    def rebuild(self):
+        """(Re-)build the index from the current state of the element"""
+        # non-empty segments in document order: (el, text_or_tail)
+        self._segments = []
+        # start and end offsets of the non-empty segments
+        self._starts = []
+        self._ends = []
+        # element -> [offset of text, offset of tail]
+        self._offsets = {}
+        count = 0
+        for (el, text_or_tail, txt) in get_t_struct(self.element,
+                                                    self.skip_els):
+            if text_or_tail == TEXT:
+                self._offsets[el] = [count, None]
+            else:
+                # skipped elements only have a tail segment
+                self._offsets.setdefault(el, [count, None])[1] = count
+            length = len(txt)
+            if length > 0:
+                self._segments.append((el, text_or_tail))
+                self._starts.append(count)
+                count += length
+                self._ends.append(count)
+        self._length = count
+        self._stale = False
+
+    def changed(self, el, text_or_tail):
+        """Notify the index that text or tail of ``el`` has changed"""
+        self._stale = True
+
+    def inserted(self, el):
+        """Notify the index that ``el`` has been inserted into the tree"""
+        self._stale = True
+
+    def removed(self, el):
+        """Notify the index that ``el`` has been removed from the tree"""
+        self._stale = True
+
+    def _find(self, pos):
+        """Return ``(el, text_or_tail, start)`` of the non-empty
+        segment containing the character at ``pos``.
+        """
+        i = bisect_right(self._ends, pos)
+        el, text_or_tail = self._segments[i]
+        return (el, text_or_tail, self._starts[i])
+
+    def _iter_segments(self, pos):
+        """Generate ``(el, text_or_tail, start)`` of all non-empty
+        segments starting with the one containing ``pos``.
+        """
+        for i in range(bisect_right(self._ends, pos), len(self._segments)):
+            el, text_or_tail = self._segments[i]
+            yield (el, text_or_tail, self._starts[i])
+
+    def goto(self, pos):
+        """Go to character position ``pos``
+
+        Same return value as ``goto(self.element, pos, skip_els)``.
+        """
+        length = len(self)
+        if pos > length or (length == 0 and pos != 0):
+            return (None, None, length)
+        if length == 0:
+            return (self.element, TEXT, 0)
+        # ``pos == length`` addresses the end of the last segment
+        el, text_or_tail, start = self._find(min(max(pos, 0), length - 1))
+        return (el, text_or_tail, pos - start)
+
+    def get_offset(self, el, text_or_tail=TEXT):
+        """Return character offset of ``el`` within the indexed element
+
+        With ``TEXT`` (the default) this is the offset at which the
+        element starts, with ``TAIL`` the offset at which its tail
+        starts.
+        """
+        if self._stale:
+            self.rebuild()
+        offsets = self._offsets.get(el)
+        if offsets is None:
+            raise XMLHelperError("Element <%s> not in index." % el.tag)
+        if text_or_tail == TEXT:
+            return offsets[0]
+        if offsets[1] is None:
+            raise XMLHelperError("Tail of element <%s> not in index." %
+                                 el.tag)
+        return offsets[1]
+
+    def get_pos(self, el):
+        """Same as ``get_pos(el, skip_els)``, but looked up in the index"""
+        parent = el.getparent()
+        if parent is None:
+            raise XMLHelperError("Element %s has no parent." % el.tag)
+        return self.get_offset(el) - self.get_offset(parent)
+
+    def get_text_range(self, start, end=None):
+        """Same as ``get_text_range(self.element, start, end, skip_els)``
+
+        Only the segments overlapping the range are read.
+        """
+        if start < 0 or (end is not None and end < 0):
+            raise XMLHelperError("Negative offsets are not supported.")
+        length = len(self)
+        if end is None or end > length:
+            end = length
+        ret = []
+        if start >= end:
+            return ""
+        for (el, text_or_tail, seg_start) in self._iter_segments(start):
+            if seg_start >= end:
+                break
+            txt = el.text if text_or_tail == TEXT else el.tail
+            ret.append(txt[max(start - seg_start, 0):end - seg_start])
+        return "".join(ret)
+
+class _Segment(object):
+    """Text or tail segment in a ``DynamicTextOffsetIndex``"""
+
+    __slots__ = ("element", "text_or_tail", "length", "block")
+
+    def __init__(self, element, text_or_tail, length):
+        self.element = element
+        self.text_or_tail = text_or_tail
+        self.length = length
+        self.block = None
+
+class _Block(object):
+    """Run of consecutive segments in a ``DynamicTextOffsetIndex``"""
+
+    __slots__ = ("segments", "length", "idx")
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.length = 0
+        for seg in segments:
+            seg.block = self
+            self.length += seg.length
+        self.idx = 0
+
+class DynamicTextOffsetIndex(TextOffsetIndex):
+    """Character offset index that is updated in place
+
+    Same interface as ``TextOffsetIndex``, but when you pass it to the
+    functions changing the tree (``insert_into_text``,
+    ``insert_into_tail``, ``insert_at``, ``delete``, ``remove_tags``,
+    ``wrap``, ``move_element`` etc.), they update the index instead of
+    invalidating it. If you change the tree yourself, either call
+    ``changed``, ``inserted``, and ``removed`` accordingly or call
+    ``rebuild``.
+
+    The text and tail segments are kept in blocks of about
+    ``block_size`` segments with a Fenwick tree over the block lengths,
+    so lookups and updates cost O(log n + block_size) instead of O(n).
+    """
+
+    block_size = 64
+
+    def rebuild(self):
+        """(Re-)build the index from the current state of the element"""
+        # element -> [text segment, tail segment]
+        self._segs = {}
+        segments = self._make_segments(get_t_struct(self.element,
+                                                    self.skip_els))
+        self._blocks = [_Block(segments[i:i + self.block_size])
+                        for i in range(0, len(segments), self.block_size)]
+        self._rebuild_tree()
+
+    def _make_segments(self, t_struct):
+        """Create and register segments for ``t_struct``"""
+        ret = []
+        for (el, text_or_tail, txt) in t_struct:
+            seg = _Segment(el, text_or_tail, len(txt))
+            if text_or_tail == TEXT:
+                self._segs[el] = [seg, None]
+            else:
+                self._segs.setdefault(el, [None, None])[1] = seg
+            ret.append(seg)
+        return ret
+
+    def _rebuild_tree(self):
+        """Renumber the blocks and rebuild the Fenwick tree"""
+        size = len(self._blocks)
+        tree = [0] * (size + 1)
+        for (i, block) in enumerate(self._blocks):
+            block.idx = i
+            j = i + 1
+            tree[j] += block.length
+            k = j + (j & -j)
+            if k <= size:
+                tree[k] += tree[j]
+        self._tree = tree
+        self._length = sum(block.length for block in self._blocks)
+        self._step = 1
+        while self._step * 2 <= size:
+            self._step *= 2
+
+    def _add(self, block, delta):
+        """Add ``delta`` to the length of ``block``"""
+        if delta == 0:
+            return
+        block.length += delta
+        self._length += delta
+        size = len(self._blocks)
+        i = block.idx + 1
+        while i <= size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _block_offset(self, block):
+        """Return the offset at which ``block`` starts"""
+        ret = 0
+        i = block.idx
+        while i > 0:
+            ret += self._tree[i]
+            i -= i & -i
+        return ret
+
+    def _find(self, pos):
+        return next(self._iter_segments(pos))
+
+    def _iter_segments(self, pos):
+        # find the block containing pos in the Fenwick tree
+        tree = self._tree
+        size = len(self._blocks)
+        i = 0
+        rest = pos
+        step = self._step
+        while step:
+            j = i + step
+            if j <= size and tree[j] <= rest:
+                i = j
+                rest -= tree[j]
+            step >>= 1
+        start = pos - rest
+        while i < size:
+            for seg in self._blocks[i].segments:
+                if seg.length > 0 and start + seg.length > pos:
+                    yield (seg.element, seg.text_or_tail, start)
+                start += seg.length
+            i += 1
+
+    def _get_segment(self, el, text_or_tail):
+        segs = self._segs.get(el)
+        if segs is None:
+            return None
+        if text_or_tail == TEXT:
+            return segs[0]
+        return segs[1]
+
+    def get_offset(self, el, text_or_tail=TEXT):
+        segs = self._segs.get(el)
+        if segs is None:
+            raise XMLHelperError("Element <%s> not in index." % el.tag)
+        if text_or_tail == TEXT:
+            # skipped elements only have a tail segment
+            seg = segs[0] or segs[1]
+        else:
+            seg = segs[1]
+            if seg is None:
+                raise XMLHelperError("Tail of element <%s> not in index." %
+                                     el.tag)
+        ret = self._block_offset(seg.block)
+        for s in seg.block.segments:
+            if s is seg:
+                return ret
+            ret += s.length
+
+    def changed(self, el, text_or_tail):
+        seg = self._get_segment(el, text_or_tail)
+        if seg is None:
+            return
+        if text_or_tail == TEXT:
+            length = len(el.text or "")
+        else:
+            length = len(el.tail or "")
+        self._add(seg.block, length - seg.length)
+        seg.length = length
+
+    def inserted(self, el):
+        if el in self._segs:
+            # el has been moved
+            self.removed(el)
+        parent = el.getparent()
+        if parent is None:
+            return
+        prv = el.getprevious()
+        if prv is None:
+            pred = self._get_segment(parent, TEXT)
+        else:
+            pred = self._get_segment(prv, TAIL)
+        if pred is None:
+            # not within the indexed part of the tree
+            return
+        if self.skip_els.ignores(el):
+            t_struct = [(el, TAIL, el.tail or "")]
+        else:
+            t_struct = list(get_t_struct(el, self.skip_els))
+            t_struct.append((el, TAIL, el.tail or ""))
+        segments = self._make_segments(t_struct)
+        block = pred.block
+        i = block.segments.index(pred) + 1
+        block.segments[i:i] = segments
+        delta = 0
+        for seg in segments:
+            seg.block = block
+            delta += seg.length
+        self._add(block, delta)
+        if len(block.segments) > 2 * self.block_size:
+            i = block.idx
+            segments = block.segments
+            self._blocks[i:i + 1] = [
+                _Block(segments[j:j + self.block_size])
+                for j in range(0, len(segments), self.block_size)]
+            self._rebuild_tree()
+
+    def removed(self, el):
+        segs = self._segs.get(el)
+        if segs is None or segs[1] is None:
+            # not in index or the indexed element itself
+            return
+        first = segs[0] or segs[1]
+        last = segs[1]
+        block = first.block
+        i = block.segments.index(first)
+        b_empty = False
+        while True:
+            seg = block.segments.pop(i)
+            self._segs.pop(seg.element, None)
+            self._add(block, -seg.length)
+            if seg is last:
+                break
+            if i == len(block.segments):
+                b_empty = b_empty or i == 0
+                block = self._blocks[block.idx + 1]
+                i = 0
+        if b_empty or not block.segments:
+            self._blocks = [b for b in self._blocks if b.segments]
+            self._rebuild_tree()
+
+class DocumentOrderIndex(object):
+    """Document order of the nodes within an element
+
+    The index numbers all nodes (elements, comments, processing
+    instructions) of the element in a single pass in document order
+    and remembers for every node the number of its last descendant.
+    Thus it can answer the questions whether one node comes before
+    another one or contains it by comparing two numbers, without
+    walking the tree.
+
+    The index reflects the element as it was when it was built. If
+    you change the element yourself, call ``invalidate`` (or
+    ``rebuild``). The functions changing the tree invalidate the
+    index, if it is passed as ``index``. Functions looking up text
+    positions (like ``goto``) walk the tree then, as they only use a
+    ``TextOffsetIndex``.
+    """
+
+    element = None
+    _stale = False
+
+    def __init__(self, element):
+        """Build the index for ``element``"""
+        self.element = element
+        self.rebuild()
+
+    def __repr__(self):
+        return u"{}({})".format(self.__class__.__name__, self.element)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __len__(self):
+        """Return number of nodes in the indexed element"""
+        if self._stale:
+            self.rebuild()
+        return len(self._positions)
+
+    def __contains__(self, node):
+        if self._stale:
+            self.rebuild()
+        return node in self._positions
+
+    def rebuild(self):
+        """(Re-)build the index from the current state of the element"""
+        nodes = list(self.element.iter())
+        # node -> number of its last descendant (or of itself)
+        last = {}
+        for i in range(len(nodes) - 1, -1, -1):
+            node = nodes[i]
+            last[node] = last[node[-1]] if len(node) else i
+        # node -> (number, number of last descendant)
+        self._positions = dict((node, (i, last[node]))
+                               for (i, node) in enumerate(nodes))
+        self._stale = False
+
+    def invalidate(self):
+        """Mark the index as outdated, it is rebuilt on the next lookup"""
+        self._stale = True
+
+    def changed(self, el, text_or_tail):
+        """Notify the index that text or tail of ``el`` has changed"""
+        pass
+
+    def inserted(self, el):
+        """Notify the index that ``el`` has been inserted into the tree"""
+        self._stale = True
+
+    def removed(self, el):
+        """Notify the index that ``el`` has been removed from the tree"""
+        self._stale = True
+
+    def _get(self, node):
+        """Return number of ``node`` and of its last descendant"""
+        if self._stale:
+            self.rebuild()
+        try:
+            return self._positions[node]
+        except KeyError:
+            raise XMLHelperError("Node %s not in index." % node)
+
+    def position(self, node):
+        """Return number of ``node`` in document order (the indexed
+        element has number 0)
+        """
+        return self._get(node)[0]
+
+    def precedes(self, node1, node2):
+        """Does ``node1`` come before ``node2`` in document order?
+
+        Ancestors come before their descendants.
+        """
+        return self._get(node1)[0] < self._get(node2)[0]
+
+    def follows(self, node1, node2):
+        """Does ``node1`` come after ``node2`` in document order?"""
+        return self._get(node1)[0] > self._get(node2)[0]
+
+    def contains(self, node1, node2):
+        """Is ``node2`` descendant of ``node1``?"""
+        start, end = self._get(node1)
+        return start < self._get(node2)[0] <= end
+
+    def compare(self, node1, node2):
+        """Return -1, 0, or 1 if ``node1`` comes before, is, or comes
+        after ``node2`` in document order
+        """
+        pos1 = self._get(node1)[0]
+        pos2 = self._get(node2)[0]
+        return (pos1 > pos2) - (pos1 < pos2)
+
+class XPathLocator(object):
+    """XPaths for many nodes of a document
+
+    Returns the same XPaths as ``get_xpath`` (and the same positions as
+    ``get_xpath_index``), but counts the children of every parent only
+    once and caches the XPaths of the ancestors. Thus the XPaths of all
+    the words in a document can be computed in linear time.
+
+    The locator reflects the document as it was when the nodes were
+    looked up. If you change the document, call ``clear``.
+
+    With ``namespaces`` (a dictionary of prefixes and namespace URIs,
+    or ``True`` for the module's ``ns``), the tags are written with
+    prefixes instead of in Clark notation, comments as ``comment()``
+    and processing instructions as ``processing-instruction()``, so
+    the XPaths can be evaluated. Namespaces without a prefix get one
+    (``ns0``, ``ns1`` etc.). All prefixes used are in ``namespaces``.
+    """
+
+    namespaces = None
+
+    def __init__(self, namespaces=None):
+        """Initialize"""
+        # namespace URI -> prefix
+        self._prefixes = None
+        if namespaces is True:
+            namespaces = ns
+        if namespaces is not None:
+            self.namespaces = dict((prefix, uri) for (prefix, uri)
+                                   in namespaces.items() if prefix)
+            self._prefixes = {}
+            for prefix in sorted(self.namespaces):
+                self._prefixes.setdefault(self.namespaces[prefix], prefix)
+        # tag -> XPath component
+        self._components = {}
+        self.clear()
+
+    def clear(self):
+        """Forget all counts and XPaths"""
+        # element -> position among siblings with same tag
+        self._indexes = {}
+        # (element, text_or_tail) -> position among text nodes
+        self._text_indexes = {}
+        # elements whose children have been counted
+        self._counted = set()
+        # element -> XPath
+        self._xpaths = {}
+
+    def _count(self, parent):
+        """Count the children of ``parent`` (once)"""
+        if parent in self._counted:
+            return
+        counts = {}
+        cnt = 0
+        if parent.text is not None:
+            cnt += 1
+            self._text_indexes[(parent, TEXT)] = cnt
+        for child in parent:
+            pos = counts.get(child.tag, 0) + 1
+            counts[child.tag] = pos
+            self._indexes[child] = pos
+            if child.tail is not None:
+                cnt += 1
+                self._text_indexes[(child, TAIL)] = cnt
+        self._counted.add(parent)
+
+    def get_xpath_index(self, node):
+        """Same as ``get_xpath_index(node)``"""
+        if isinstance(node, TextNode):
+            if node.empty:
+                raise XMLHelperError(
+                    "Cannot determine XPath for empty TextNode.")
+            self._count(node.parent)
+            return self._text_indexes[node.key]
+        parent = node.getparent()
+        if parent is None:
+            return 1
+        self._count(parent)
+        return self._indexes[node]
+
+    def get_xpath(self, node):
+        """Same as ``get_xpath(node)``"""
+        if isinstance(node, TextNode):
+            return "%s/text()[%d]" % (self._get_element_xpath(node.parent),
+                                      self.get_xpath_index(node))
+        return self._get_element_xpath(node)
+
+    def get_xpaths(self, nodes):
+        """Return list of the XPaths of ``nodes``"""
+        return [self.get_xpath(node) for node in nodes]
+
+    def _get_element_xpath(self, el):
+        """Return XPath of element ``el``"""
+        ret = self._xpaths.get(el)
+        if ret is not None:
+            return ret
+        # ancestors without cached XPath, nearest first
+        els = []
+        prefix = ""
+        while el is not None:
+            cached = self._xpaths.get(el)
+            if cached is not None:
+                prefix = cached
+                break
+            els.append(el)
+            el = el.getparent()
+        for el in reversed(els):
+            prefix = self._xpaths[el] = "%s/%s[%d]" % (
+                prefix, self._get_component(el.tag), self.get_xpath_index(el))
+        return prefix
+
+    def _get_component(self, tag):
+        """Return XPath component for ``tag``"""
+        if self._prefixes is None:
+            return tag
+        ret = self._components.get(tag)
+        if ret is not None:
+            return ret
+        if tag is et.Comment:
+            ret = "comment()"
+        elif tag is et.PI:
+            ret = "processing-instruction()"
+        elif isinstance(tag, (str, unitext)) and tag.startswith("{"):
+            uri, local = tag[1:].split("}", 1)
+            prefix = self._prefixes.get(uri)
+            if prefix is None:
+                prefix = self._add_prefix(uri)
+            ret = "%s:%s" % (prefix, local)
+        else:
+            ret = "%s" % tag
+        self._components[tag] = ret
+        return ret
+
+    def _add_prefix(self, uri):
+        """Add a new prefix for the namespace ``uri``"""
+        i = 0
+        while "ns%d" % i in self.namespaces:
+            i += 1
+        prefix = "ns%d" % i
+        self.namespaces[prefix] = uri
+        self._prefixes[uri] = prefix
+        return prefix
+
+    def compile(self, node):
+        """Return XPath of ``node`` compiled to an ``etree.XPath``
+        object (with ``namespaces``)
+        """
+        return et.XPath(self.get_xpath(node), namespaces=self.namespaces)
+
+class XPathCache(object):
+    """Cache of compiled XPath expressions
+
+    Evaluating a string expression with ``el.xpath`` compiles it
+    every time. The cache keeps the ``etree.XPath`` objects for the
+    ``size`` most recently used combinations of expression and
+    namespaces (least recently used ones are dropped first) and
+    counts ``hits`` and ``misses``.
+
+    The key for a namespace mapping is remembered for the mapping
+    object, so that large mappings like ``ns`` are not hashed on every
+    lookup. Changes of a mapping keeping its length are not noticed;
+    call ``clear`` after such changes.
+    """
+
+    def __init__(self, size=256):
+        """Initialize"""
+        self.size = size
+        self.clear()
+
+    def __repr__(self):
+        return u"{}(size={}, hits={}, misses={})".format(
+            self.__class__.__name__, self.size, self.hits, self.misses)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        """Empty the cache and reset the statistics"""
+        self._cache = OrderedDict()
+        # id of mapping -> (mapping, length, key)
+        self._keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, expr, namespaces=None):
+        """Return ``expr`` compiled to an ``etree.XPath`` object"""
+        key = (expr, self._get_namespaces_key(namespaces))
+        ret = self._cache.pop(key, None)
+        if ret is not None:
+            self.hits += 1
+            # reinsert as most recently used (no move_to_end in python 2)
+            self._cache[key] = ret
+            return ret
+        self.misses += 1
+        ret = et.XPath(expr, namespaces=namespaces)
+        self._cache[key] = ret
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+        return ret
+
+    def _get_namespaces_key(self, namespaces):
+        """Return the part of the cache key for ``namespaces``"""
+        if namespaces is None:
+            return None
+        entry = self._keys.get(id(namespaces))
+        if (entry is not None and entry[0] is namespaces
+                and entry[1] == len(namespaces)):
+            return entry[2]
+        key = frozenset(namespaces.items())
+        if len(self._keys) >= self.size:
+            # mappings created for single calls
+            self._keys.clear()
+        self._keys[id(namespaces)] = (namespaces, len(namespaces), key)
+        return key
+
+# used by ``xpath`` and internally
+xpath_cache = XPathCache()
+
 class TransformerError(XMLHelperError):
     pass
 
 class TransformerNotFoundError(TransformerError):
     pass
 
+def handles(*tags):
+    """Decorator registering a ``Transformer`` method for elements
+
+    The tags are given in Clark notation (``"{uri}local"``, or just
+    ``"local"`` for elements without namespace); ``"{*}local"``
+    registers the method for ``local`` in any namespace::
+
+        class TEITransformer(Transformer):
+            @handles("{%s}p" % ns["tei"])
+            def _tei_p(self, element):
+                ...
+
+    Registered methods take precedence over the ``_convert_``
+    methods.
+    """
+    def decorator(func):
+        func._handles = tags
+        return func
+    return decorator
+
 class Transformer(object):
     """Basic infrastructure for a simple XML transformer
+
+    Subtrees without any nodes needing special treatment are copied
+    as a whole (see ``_can_copy``). Which subtrees these are is
+    determined once the transformation has started, so the methods
+    transforming elements must not add or move such nodes in the
+    input document. Set ``copy_subtrees`` to ``False`` if they do.
     """
 
     # the input ElementTree
@@ -420,6 +1351,19 @@ class Transformer(object):
     root = None
     # dictionary for index
     _ids = None
+    # attributes to index (Clark notation or with prefix from ``ns``),
+    # see ``get_elements_by``
+    index_attributes = ()
+    # tags to index (also "{*}local"), see ``get_elements_by_tag``
+    index_tags = ()
+    # attributes pointing to xml:ids, see ``get_referencing_elements``
+    reference_attributes = ()
+    # attribute -> value -> elements
+    _attribute_index = None
+    # tag -> elements
+    _tag_index = None
+    # xml:id -> elements pointing to it
+    _references = None
     # skip processing instructions?
     skip_pis = False
     # skip comments?
@@ -432,8 +1376,31 @@ class Transformer(object):
     # as they are used elsewhere or to be
     # ignored completely
     skip_nodes = None
+    # transform children with an explicit stack instead of recursion
+    iterative = False
+    # reuse the elements of the input document in the output
+    in_place = False
+    # copy subtrees without nodes needing special treatment as a whole
+    copy_subtrees = True
+    # tag -> name of the method registered with ``handles``
+    # (per class)
+    _handlers = None
+    # tag -> method transforming the element (or None)
+    _dispatch = None
+    # tags of the elements (and node types) that prevent copying a
+    # subtree, False if no subtree can be copied (see ``_can_copy``)
+    _copy_probe = None
+    # elements containing nodes found by the probe and the root element
+    # they were collected for (see ``_can_copy``)
+    _uncopyable = None
+    _uncopyable_root = None
 
     def __init__(self, input_doc, **kwargs):
+        """Initialize
+
+        ``input_doc`` may be ``None`` for subclasses which set the
+        document later (like ``StreamingTransformer``).
+        """
         if isinstance(input_doc, et._Element):
             self.input_doc = et.ElementTree(input_doc)
             self.root = input_doc
@@ -441,8 +1408,19 @@ class Transformer(object):
             self.input_doc = input_doc
             self.root = input_doc.getroot()
         self._ids = {}
-        self.front_nodes = self._get_front_nodes()
+        if self.root is None:
+            self.front_nodes = []
+        else:
+            self.front_nodes = self._get_front_nodes()
         self.skip_nodes = set()
+        self._set_options(kwargs)
+
+    def _set_options(self, kwargs):
+        """Set the options given as keyword arguments
+
+        Return the unknown ones.
+        """
+        ret = {}
         for (k, v) in kwargs.items():
             if k == "skip_pis":
                 self.skip_pis = v
@@ -450,6 +1428,15 @@ class Transformer(object):
                 self.skip_comments = v
             elif k == "strip_namespaces":
                 self.strip_namespaces = v
+            elif k == "iterative":
+                self.iterative = v
+            elif k == "in_place":
+                self.in_place = v
+            elif k == "copy_subtrees":
+                self.copy_subtrees = v
+            else:
+                ret[k] = v
+        return ret
 
     def __repr__(self):
         return u"Transformer({})".format(self.input_doc)
@@ -468,8 +1455,75 @@ class Transformer(object):
             node = node.getprevious()
         return ret
 
+    @classmethod
+    def transform_many(cls, paths, workers=None, output_dir=None,
+                       ordered=True, chunksize=1, **kwargs):
+        """Transform many files in parallel processes
+
+        Every file in ``paths`` is parsed, transformed (by an instance
+        of this class created with ``kwargs``), and serialized in a
+        pool of ``workers`` processes (default: number of CPUs; with
+        ``workers=1`` the files are transformed in this process). The
+        paths are handed to the processes ``chunksize`` at a time.
+
+        Generate ``(path, result, error)`` for every file, in the
+        order of ``paths`` if ``ordered`` (else as soon as they are
+        ready). ``result`` is the serialized output or, if
+        ``output_dir`` is given, the path of the file written there
+        (with the path of the input file relative to the directory
+        containing all the input files). If the transformation
+        failed, ``result`` is ``None`` and ``error`` is the traceback
+        (as string), else ``error`` is ``None``.
+
+        The class must be importable by the worker processes, i. e.
+        defined at the top level of a module. Under Python 2, worker
+        processes need the ``futures`` backport of ``concurrent.futures``.
+        """
+        paths = list(paths)
+        if output_dir is None:
+            jobs = [(path, None) for path in paths]
+        else:
+            jobs = list(zip(paths, _get_output_paths(paths, output_dir)))
+            for (_, output_path) in jobs:
+                directory = os.path.dirname(output_path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+        chunks = [jobs[i:i + chunksize]
+                  for i in range(0, len(jobs), chunksize)]
+        if workers == 1:
+            for chunk in chunks:
+                for ret in _transform_files(cls, chunk, kwargs):
+                    yield ret
+            return
+        # python 2 needs the futures backport for this
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(_transform_files, cls, chunk, kwargs)
+                       for chunk in chunks]
+            if not ordered:
+                futures = as_completed(futures)
+            for future in futures:
+                for ret in future.result():
+                    yield ret
+
+    @classmethod
+    def _transform_file(cls, path, output_path=None, **kwargs):
+        """Transform the file ``path`` (see ``transform_many``)"""
+        ret = cls(et.parse(path), **kwargs).transform()
+        if output_path is None:
+            if isinstance(ret, et._ElementTree):
+                return et.tostring(ret, encoding="unicode")
+            return ret
+        if isinstance(ret, et._ElementTree):
+            ret.write(output_path, encoding="UTF-8", xml_declaration=True)
+        else:
+            with io_open(output_path, "w", encoding="UTF-8") as f:
+                f.write(ret)
+        return output_path
+
     def transform(self):
         """Run the transformation"""
+        self._uncopyable_root = None
         self._preprocessing()
         self.index()
         ret = self._transform_document()
@@ -495,9 +1549,46 @@ class Transformer(object):
 
     def index_iter(self):
         """Iterate over all elements, add them to the default index.
+
+        The ``index_attributes``, ``index_tags``, and the
+        ``reference_attributes`` are indexed, too.
         """
+        self._attribute_index = dict(
+            (_qualify_name(name), {}) for name in self.index_attributes)
+        self._tag_index = dict(
+            (_qualify_name(tag), []) for tag in self.index_tags)
+        self._references = {}
+        attributes = list(self._attribute_index.items())
+        tags = self._tag_index
+        references = [_qualify_name(name)
+                      for name in self.reference_attributes]
+        if not attributes and not tags and not references:
+            for e in self.root.iter():
+                self._add_to_id_index(e)
+                yield e
+            return
+        wildcards = any(tag.startswith("{*}") for tag in tags)
         for e in self.root.iter():
             self._add_to_id_index(e)
+            for (name, index) in attributes:
+                value = e.get(name)
+                if value is not None:
+                    index.setdefault(value, []).append(e)
+            for name in references:
+                value = e.get(name)
+                if value is not None:
+                    for xmlid in self._parse_references(value):
+                        referencing = self._references.setdefault(xmlid, [])
+                        if not referencing or referencing[-1] is not e:
+                            referencing.append(e)
+            if tags:
+                tag = e.tag
+                if tag in tags:
+                    tags[tag].append(e)
+                if wildcards and isinstance(tag, (str, unitext)):
+                    tag = "{*}" + strip_namespace_from_tagname(tag)
+                    if tag in tags:
+                        tags[tag].append(e)
             yield e
 
     def index(self):
@@ -527,8 +1618,86 @@ class Transformer(object):
             raise TransformerNotFoundError(u"ID %s not found." % xmlid)
         return ret
 
+    def get_elements_by(self, attribute, value):
+        """Return list of the elements with ``attribute`` set to
+        ``value``
+
+        The attribute must be one of the ``index_attributes``.
+        """
+        try:
+            index = self._attribute_index[_qualify_name(attribute)]
+        except (KeyError, TypeError):
+            raise TransformerError(u"Attribute %s not indexed." % attribute)
+        return index.get(value, [])
+
+    def _parse_references(self, value):
+        """Return list of the xml:ids in the value of a reference
+        attribute
+
+        The value is split at whitespace, pointers like ``#id`` and
+        plain IDREFs like ``id`` are taken, pointers to other documents
+        (``doc.xml#id``) are ignored. Override this for other syntaxes.
+        """
+        ret = []
+        for token in value.split():
+            if token.startswith("#"):
+                ret.append(token[1:])
+            elif not "#" in token:
+                ret.append(token)
+        return ret
+
+    def get_referencing_elements(self, element_or_id):
+        """Return list of the elements pointing to the given element
+        (or xml:id) with one of the ``reference_attributes``
+        """
+        xmlid = element_or_id
+        if not isinstance(element_or_id, (str, unitext)):
+            xmlid = element_or_id.get("{%s}id" % ns["xml"])
+        return (self._references or {}).get(xmlid, [])
+
+    def get_referenced_elements(self, element, attribute=None):
+        """Return list of the elements ``element`` points to with one of
+        the ``reference_attributes`` (or with ``attribute``)
+
+        Pointers to unknown xml:ids are ignored.
+        """
+        if attribute is None:
+            names = [_qualify_name(name)
+                     for name in self.reference_attributes]
+        else:
+            names = [_qualify_name(attribute)]
+        ret = []
+        for name in names:
+            value = element.get(name)
+            if value is None:
+                continue
+            for xmlid in self._parse_references(value):
+                el = self._ids.get(xmlid)
+                if el is not None:
+                    ret.append(el)
+        return ret
+
+    def get_elements_by_tag(self, tag):
+        """Return list of the elements with ``tag``
+
+        The tag must be one of the ``index_tags``.
+        """
+        try:
+            return self._tag_index[_qualify_name(tag)]
+        except (KeyError, TypeError):
+            raise TransformerError(u"Tag %s not indexed." % tag)
+
     def _transform_document(self):
         ret = self._transform_node(self.root)
+        self._cleanup_namespaces(ret)
+        if self.in_place and ret is self.root:
+            # front nodes are still there
+            for node in self.front_nodes:
+                tag = node.tag
+                if ((tag is et.PI and self.skip_pis)
+                        or (tag is et.Comment and self.skip_comments)):
+                    self._remove_front_node(node)
+            return ret
         for node in self.front_nodes:
             tag = node.tag
             if ((tag is et.PI and not self.skip_pis)
@@ -536,6 +1705,27 @@ class Transformer(object):
                 self._addprevious(ret, node)
         return ret
 
+    def _cleanup_namespaces(self, ret):
+        """Remove the namespace declarations no longer used by the
+        reused elements in ``ret`` (if ``in_place`` and
+        ``strip_namespaces``)
+        """
+        if not (self.in_place and self.strip_namespaces):
+            return
+        if not isinstance(ret, list):
+            ret = [ret]
+        for item in ret:
+            if isinstance(item, et._Element):
+                et.cleanup_namespaces(item)
+
+    @staticmethod
+    def _remove_front_node(node):
+        """Remove ``node`` in front of the root element"""
+        # lxml cannot remove a sibling of the root element directly
+        # (it has no parent), but moving it into another element takes
+        # it out of the document. That element is discarded.
+        et.Element("discarded").append(node)
+
     def _addprevious(self, target, node):
         """
         Add ``node`` before ``target`` if ``target`` is an element.
@@ -568,13 +1758,19 @@ class Transformer(object):
             return self._transform_element(node)
 
     def _transform_comment(self, comment):
-        """Hook to transform comment node. Default is deepcopy."""
+        """Hook to transform comment node. Default is deepcopy
+        (or the comment itself, if ``in_place``)."""
+        if self.in_place:
+            return comment
         ret = deepcopy(comment)
         ret.tail = None
         return ret
 
     def _transform_pi(self, processing_instruction):
-        """Hook to transform processing instruction. Default is deepcopy."""
+        """Hook to transform processing instruction. Default is deepcopy
+        (or the processing instruction itself, if ``in_place``)."""
+        if self.in_place:
+            return processing_instruction
         ret = deepcopy(processing_instruction)
         ret.tail = None
         return ret
@@ -598,9 +1794,17 @@ class Transformer(object):
                     newtail = (target[-1].tail or "") + stuff
                     target[-1].tail = newtail
             elif isinstance(stuff, list):
-                flattened = Transformer._flatten(stuff)
-                for item in flattened:
-                    Transformer._append_to(target, item)
+                new_els = []
+                for item in Transformer._iter_flat(stuff):
+                    if not isinstance(item, (str, unitext)):
+                        new_els.append(item)
+                    elif new_els:
+                        new_els[-1].tail = (new_els[-1].tail or "") + item
+                    elif len(target) == 0:
+                        target.text = (target.text or "") + item
+                    else:
+                        target[-1].tail = (target[-1].tail or "") + item
+                target.extend(new_els)
             else:
                 target.append(stuff)
         return target
@@ -614,49 +1818,62 @@ class Transformer(object):
         a lot of time if we already have eliminated the
         texts as they can all be added as tails.
         """
-        ret = []
-        wild_list = [x for x in wild_list if x is not None]
-        max = len(wild_list)
-        i = 0
-        item = None
-        while i < max:
-            if item is None:
-                item = wild_list[i]
-            nxt = None if i + 1 == max else wild_list[i + 1]
-            if isinstance(item, (str, unitext)):
-                if nxt is not None:
-                    if isinstance(nxt, (str, unitext)):
-                        item += nxt
-                        i += 1
-                    else:
-                        ret.append(item)
-                        item = None
-                        i += 1
-                else:
-                    i += 1
-                    ret.append(item)
-                    item = None
-            elif isinstance(item, (et._Element)):
-                if nxt is not None:
-                    if isinstance(nxt, (str, unitext)):
-                        item.tail = (item.tail or "") + nxt
-                        i += 1
-                    else:
-                        ret.append(item)
-                        item = None
-                        i += 1
+        return list(Transformer._iter_flat(wild_list))
+
+    @staticmethod
+    def _iter_flat(wild_list):
+        """Generate the items of the (nested) ``wild_list`` as
+        returned by ``_flatten``
+
+        ``None`` is dropped, texts following an element are added to
+        its tail, other adjacent texts are joined. Only the items
+        right before the lists in ``wild_list`` itself (not in the
+        nested lists) are not joined with their first items.
+        """
+        # texts not added yet
+        texts = []
+        # element the texts are the tail of
+        last = None
+
+        def finish():
+            """Return the item finished by ``texts`` (or None)"""
+            if last is not None:
+                if texts:
+                    last.tail = (last.tail or "") + "".join(texts)
+                return last
+            if texts:
+                return "".join(texts)
+            return None
+
+        stack = [iter(wild_list)]
+        while stack:
+            for item in stack[-1]:
+                if item is None:
+                    continue
+                if isinstance(item, (str, unitext)):
+                    texts.append(item)
+                elif isinstance(item, list):
+                    if len(stack) == 1:
+                        ret = finish()
+                        if ret is not None:
+                            yield ret
+                        texts = []
+                        last = None
+                    stack.append(iter(item))
+                    break
+                elif isinstance(item, et._Element):
+                    ret = finish()
+                    if ret is not None:
+                        yield ret
+                    texts = []
+                    last = item
                 else:
-                    i += 1
-                    ret.append(item)
-                    item = None
-            elif isinstance(item, (list)):
-                new_list = Transformer._flatten(item)
-                wild_list = wild_list[0:i] + new_list + wild_list[i + 1:]
-                max = len(wild_list)
-                item = None
+                    raise TransformerError("Unknown type: " + str(type(item)))
             else:
-                raise TransformerError("Unknown type: " + str(type(item)))
-        return ret
+                stack.pop()
+        ret = finish()
+        if ret is not None:
+            yield ret
 
     def _transform_element(self, element):
         """Transform of an element
@@ -674,21 +1891,213 @@ class Transformer(object):
         return self._default_element_transformation(element)
 
     def _find_default_method(self, element):
-        name = strip_namespace_from_tagname(element.tag)
-        name = "_convert_" + name
-        return getattr(self, name, None)
+        """Return the method transforming ``element`` (or None)
+
+        This is the method registered for its tag with ``handles``
+        or (if there is none) the method named ``_convert_`` plus the
+        local name of the tag. The result is cached per tag.
+        """
+        tag = element.tag
+        try:
+            return self._dispatch[tag]
+        except KeyError:
+            pass
+        except TypeError:
+            self._dispatch = {}
+        handlers = self._get_handlers()
+        name = strip_namespace_from_tagname(tag)
+        method_name = handlers.get(tag) or \
+            handlers.get("{*}" + name) or "_convert_" + name
+        ret = self._dispatch[tag] = getattr(self, method_name, None)
+        return ret
+
+    @classmethod
+    def _get_handlers(cls):
+        """Return tag -> name of the method registered with ``handles``"""
+        handlers = cls.__dict__.get("_handlers")
+        if handlers is None:
+            handlers = {}
+            for klass in reversed(cls.__mro__):
+                for (name, value) in vars(klass).items():
+                    for tag in getattr(value, "_handles", ()):
+                        handlers[tag] = name
+            cls._handlers = handlers
+        return handlers
 
     def _default_element_transformation(self, element):
         """Default transformation of an element.
 
         This produces basically a copy of the element and
         applies ``_transform_node`` to all its children.
+
+        If ``in_place``, the element itself is reused instead.
         """
+        ret, descend = self._start_default_transformation(element)
+        if descend:
+            self._finish_default_transformation(
+                ret, self._transform_children(element))
+        return ret
+
+    def _start_default_transformation(self, element):
+        """Start the default transformation of ``element``
+
+        Return ``(ret, descend)``: ``ret`` is the transformation of
+        ``element`` (a copy of the subtree, see ``_can_copy``, or the
+        target element with the attributes; ``element`` itself if
+        ``in_place``), ``descend`` tells whether the children still
+        have to be transformed and added with
+        ``_finish_default_transformation``.
+        """
+        if self._can_copy(element):
+            if self.in_place:
+                return element, False
+            return self._copy_subtree(element), False
+        if self.in_place:
+            self._reuse_element(element)
+            return element, True
         ret = self._create_target_element(element)
         self._transform_attributes(element, ret)
-        self._append_to(ret, self._transform_children(element))
+        return ret, True
+
+    def _finish_default_transformation(self, target, stuff):
+        """Add the transformed children ``stuff`` to ``target`` (see
+        ``_start_default_transformation``)
+        """
+        if self.in_place:
+            self._replace_content(target, stuff)
+        else:
+            self._append_to(target, stuff)
+
+    def _can_copy(self, element):
+        """Is the default transformation of ``element`` just a copy?
+
+        This is the case if the default transformation is used for
+        all the nodes within ``element`` (no method for any of the
+        tags, no skipped nodes etc.). Then ``element`` can be copied
+        with ``deepcopy`` instead of being rebuilt node by node.
+
+        The elements of the document that cannot be copied are
+        collected in one pass (when the first element is transformed,
+        i. e. after ``_preprocessing``), so that each subtree is
+        examined only once while descending into it. Later changes of
+        the input document are not noticed (see ``copy_subtrees``).
+        """
+        if not self.copy_subtrees:
+            return False
+        probe = self._get_copy_probe()
+        if probe is False or self.skip_nodes:
+            return False
+        if self._uncopyable_root is not self.root:
+            self._collect_uncopyable(probe)
+        uncopyable = self._uncopyable
+        if element in uncopyable:
+            return False
+        parent = element.getparent()
+        if element is self.root or parent in uncopyable:
+            return True
+        # not below an element seen by _collect_uncopyable
+        for _ in element.iter(*probe):
+            return False
+        return True
+
+    def _collect_uncopyable(self, probe):
+        """Collect the elements below ``self.root`` that contain nodes
+        found by ``probe`` (see ``_can_copy``)
+        """
+        uncopyable = set()
+        for node in self.root.iter(*probe):
+            # stop at elements already collected, their ancestors
+            # are in the set as well
+            while node is not None and node not in uncopyable:
+                uncopyable.add(node)
+                if node is self.root:
+                    break
+                node = node.getparent()
+        self._uncopyable = uncopyable
+        self._uncopyable_root = self.root
+
+    def _reuse_element(self, element):
+        """Prepare ``element`` for being its own transformation (if
+        ``in_place``)
+
+        Only the tag is changed if ``strip_namespaces``, the attributes
+        are kept (``_transform_attributes`` is called with ``element``
+        as target).
+        """
+        if self.strip_namespaces:
+            element.tag = et.QName(element).localname
+        self._transform_attributes(element, element)
+
+    def _replace_content(self, element, stuff):
+        """Replace the content of ``element`` with the transformed
+        children ``stuff`` (if ``in_place``)
+
+        Children that are their own transformation keep their tails
+        (see ``_transform_children``). If ``stuff`` consists of the
+        text and the very same children, the element is left as it is.
+        """
+        i = 0
+        n = len(stuff)
+        unchanged = True
+        if element.text is not None:
+            unchanged = n > 0 and stuff[0] == element.text
+            i = 1
+        if unchanged:
+            for child in element:
+                if i == n or stuff[i] is not child:
+                    unchanged = False
+                    break
+                i += 1
+        if unchanged and i == n:
+            return
+        element.text = None
+        del element[:]
+        self._append_to(element, stuff)
+
+    def _copy_subtree(self, element):
+        """Return the default transformation of ``element`` if
+        ``_can_copy``
+
+        Only the element itself is created as usual (with the
+        namespaces in scope), the content is copied with
+        ``deepcopy``.
+        """
+        ret = self._create_target_element(element)
+        self._transform_attributes(element, ret)
+        ret.text = element.text
+        for child in element:
+            ret.append(deepcopy(child))
         return ret
 
+    def _get_copy_probe(self):
+        """Return the tags for ``_can_copy`` (computed once)"""
+        if self._copy_probe is not None:
+            return self._copy_probe
+        cls = self.__class__
+        for name in ("_transform_node", "_transform_element",
+                     "_find_default_method", "_default_element_transformation",
+                     "_create_target_element", "_transform_attributes",
+                     "_transform_children", "_append_to", "_transform_text"):
+            if getattr(cls, name) is not getattr(Transformer, name):
+                self._copy_probe = False
+                return False
+        if self.strip_namespaces:
+            self._copy_probe = False
+            return False
+        tags = set(self._get_handlers())
+        for name in dir(self):
+            if name.startswith("_convert_"):
+                tags.add("{*}" + name[len("_convert_"):])
+        tags.add(et.Entity)
+        if (self.skip_comments or
+                cls._transform_comment is not Transformer._transform_comment):
+            tags.add(et.Comment)
+        if (self.skip_pis or
+                cls._transform_pi is not Transformer._transform_pi):
+            tags.add(et.PI)
+        self._copy_probe = tuple(tags)
+        return self._copy_probe
+
     def _create_target_element(self, element):
         """Create a target element for transformation"""
         if self.strip_namespaces:
@@ -703,14 +2112,172 @@ class Transformer(object):
             target.set(a, v)
 
     def _transform_children(self, element):
-        """Transform all children of ``element`` and append to ``target``"""
+        """Transform all children of ``element`` and append to ``target``
+
+        If ``in_place``, a child that is its own transformation keeps
+        its tail (unless the texts are transformed as TextNodes, then
+        the tails are removed).
+        """
+        if self.iterative:
+            return self._transform_children_iteratively(element)
+        # no need for TextNodes?
+        plain = not self.skip_nodes and self._has_default_text_handling()
+        ret = []
+        for child in self._iter_child_nodes(element, plain):
+            if plain and isinstance(child, (str, unitext)):
+                ret.append(child)
+                continue
+            self._add_transformed_child(ret, child,
+                                        self._transform_node(child), plain)
+        return ret
+
+    def _transform_child(self, child, inline):
+        """Transform ``child`` (a node from ``_iter_child_nodes``)
+
+        Return ``(stuff, descend)``. If ``inline`` and ``child`` is
+        an element transformed by default, this is the result of
+        ``_start_default_transformation`` (so the caller descends into
+        ``child`` itself if ``descend``), else ``stuff`` is the result
+        of ``_transform_node`` and ``descend`` is ``False``.
+        """
+        if (inline and isinstance(child, et._Element) and
+                isinstance(child.tag, (str, unitext)) and
+                self._find_default_method(child) is None):
+            return self._start_default_transformation(child)
+        return self._transform_node(child), False
+
+    def _add_transformed_child(self, target, child, stuff, plain):
+        """Add the transformation ``stuff`` of ``child`` to ``target``
+        (a list or an element)
+
+        If ``plain`` (no TextNodes), the tail of ``child`` is added as
+        well, unless ``child`` is its own transformation and keeps its
+        tail (if ``in_place``).
+        """
+        self._append_to(target, stuff)
+        if plain and child.tail is not None and not (
+                self.in_place and stuff is child):
+            self._append_to(target, child.tail)
+
+    def _transform_children_iteratively(self, element):
+        """Same as ``_transform_children``, but without recursion
+
+        The descendants without a method of their own (see
+        ``_find_default_method``) are transformed with a stack instead
+        of recursive calls of ``_transform_node``, so there is no limit
+        to the depth of the document. This requires the default
+        ``_transform_node``, ``_transform_element``,
+        ``_default_element_transformation``, ``_transform_children``,
+        and ``_append_to``, otherwise these are called for every child
+        as usual.
+        """
+        cls = self.__class__
+        inline = (
+            cls._transform_node is Transformer._transform_node and
+            cls._transform_element is Transformer._transform_element and
+            cls._default_element_transformation is
+            Transformer._default_element_transformation and
+            cls._transform_children is Transformer._transform_children and
+            cls._append_to is Transformer._append_to)
+        plain = not self.skip_nodes and self._has_default_text_handling()
+        if plain and not self.in_place:
+            return self._transform_texts_iteratively(element, inline)
         ret = []
+        # (source element, target element, transformed children,
+        # iterator over children)
+        stack = [(element, None, ret, self._iter_child_nodes(element, plain))]
+        while stack:
+            source, target, result, children = stack[-1]
+            for child in children:
+                if plain and isinstance(child, (str, unitext)):
+                    result.append(child)
+                    continue
+                stuff, descend = self._transform_child(child, inline)
+                if descend:
+                    stack.append((child, stuff, [],
+                                  self._iter_child_nodes(child, plain)))
+                    break
+                self._add_transformed_child(result, child, stuff, plain)
+            else:
+                stack.pop()
+                if target is None:
+                    continue
+                self._finish_default_transformation(target, result)
+                self._add_transformed_child(stack[-1][2], source, target,
+                                            plain)
+        return ret
+
+    def _iter_child_nodes(self, element, plain=False):
+        """Generate the child nodes of ``element`` except the
+        ``skip_nodes``
+
+        The texts are generated as TextNodes, or, if ``plain``, the
+        text of ``element`` as string (the tails are left to the
+        caller, as in ``_transform_children``).
+        """
+        if plain:
+            if element.text is not None:
+                yield element.text
+            for child in element:
+                yield child
+            return
         for child_node in AllChildNodesIterator(element):
+            if self.in_place and isinstance(child_node, TextNode):
+                self._remove_tail(child_node)
             if not child_node in self.skip_nodes:
-                # ret.append(self._transform_node(child_node))
-                self._append_to(ret, self._transform_node(child_node))
+                yield child_node
+
+    @staticmethod
+    def _remove_tail(text_node):
+        """Remove the tail the TextNode was created from (if
+        ``in_place``)
+        """
+        if text_node.previous is not None:
+            text_node.previous.tail = None
+
+    def _transform_texts_iteratively(self, element, inline):
+        """``_transform_children_iteratively`` for the default handling
+        of texts (no TextNodes needed)
+
+        The children transformed by default are appended to their
+        target elements right away.
+        """
+        ret = []
+        if element.text is not None:
+            ret.append(element.text)
+        # (source element, target element or ret, iterator over children)
+        stack = [(element, ret, iter(element))]
+        while stack:
+            source, target, children = stack[-1]
+            for child in children:
+                stuff, descend = self._transform_child(child, inline)
+                if descend:
+                    if child.text is not None:
+                        self._add_text(stuff, child.text)
+                    stack.append((child, stuff, iter(child)))
+                    break
+                self._add_transformed_child(target, child, stuff, True)
+            else:
+                stack.pop()
+                if stack:
+                    self._add_transformed_child(stack[-1][1], source, target,
+                                                True)
         return ret
 
+    @staticmethod
+    def _add_text(target, text):
+        """Add ``text`` at the end of the element ``target``"""
+        if len(target) == 0:
+            target.text = (target.text or "") + text
+        else:
+            target[-1].tail = (target[-1].tail or "") + text
+
+    def _has_default_text_handling(self):
+        """Are TextNodes transformed to their text (as by default)?"""
+        cls = self.__class__
+        return (cls._transform_text is Transformer._transform_text and
+                cls._transform_node is Transformer._transform_node)
+
     def _transform_text(self, text_node):
         """Hook to work with TextNodes
         """
@@ -738,6 +2305,240 @@ class Transformer(object):
         """Hook for finishing touches"""
         return doc
 
+# keyword arguments of ``iterparse`` (for ``StreamingTransformer``)
+_iterparse_options = frozenset([
+    "attribute_defaults", "collect_ids", "compact", "dtd_validation",
+    "encoding", "huge_tree", "load_dtd", "no_network", "recover",
+    "remove_blank_text", "remove_comments", "remove_pis",
+    "resolve_entities", "schema", "strip_cdata"])
+
+class StreamingTransformer(Transformer):
+    """Transformer for huge documents consisting of independent records
+
+    The input is parsed with ``iterparse`` and every record (an
+    element with the tag ``record_tag``, or one of the tags, if it is
+    a list) is transformed as soon as it has been parsed, as if it
+    were the root of a document of its own (``self.root`` is the
+    record and ``get_element_by_id`` finds the IDs within the record).
+    The result is written to the output right away, and the record is
+    removed from the input tree, so memory is bounded by the largest
+    record, not by the document.
+
+    The elements containing records are copied to the output with
+    ``_create_target_element`` and ``_transform_attributes``.
+    Everything else (elements not containing records, comments,
+    processing instructions, texts) is transformed with
+    ``_transform_node``. ``_preprocessing`` and ``_post_processing``
+    are not called, as there is no complete document.
+
+    To stream an existing ``Transformer`` subclass, derive a class
+    from both::
+
+        class StreamingTEITransformer(StreamingTransformer,
+                                      TEITransformer):
+            record_tag = "{%s}TEI" % ns["tei"]
+
+        StreamingTEITransformer("corpus.xml").transform("out.xml")
+    """
+
+    # the tag(s) of the records
+    record_tag = None
+    # the input file (name or file object)
+    source = None
+    # keyword arguments for iterparse
+    iterparse_kwargs = None
+
+    def __init__(self, source, record_tag=None, **kwargs):
+        """Initialize
+
+        The keyword arguments are passed on to the ``__init__`` of the
+        other base classes (with ``None`` as document), the options of
+        ``iterparse`` (e.g. ``huge_tree=True``) also to ``iterparse``.
+        """
+        self.source = source
+        if record_tag is not None:
+            self.record_tag = record_tag
+        if self.record_tag is None:
+            raise TransformerError("No record tag given.")
+        super(StreamingTransformer, self).__init__(None, **kwargs)
+        self.iterparse_kwargs = dict(
+            (k, v) for (k, v) in kwargs.items() if k in _iterparse_options)
+        # records and other elements written already, only kept in
+        # the input tree for their tails
+        self._written = set()
+
+    def __repr__(self):
+        return u"StreamingTransformer({})".format(self.source)
+
+    def transform(self, sink, encoding="UTF-8", xml_declaration=True):
+        """Run the transformation, write the result to ``sink``
+
+        ``sink`` is a file name or a file object.
+        """
+        record_tags = self.record_tag
+        if not isinstance(record_tags, (list, tuple, set, frozenset)):
+            record_tags = [record_tags]
+        record_tags = frozenset(record_tags)
+        with et.xmlfile(sink, encoding=encoding) as xf:
+            if xml_declaration:
+                xf.write_declaration()
+            # elements containing the current position (outside of the
+            # records) and the contexts of those written already
+            frames = []
+            contexts = []
+            # depth within the current record (0: not within a record)
+            depth = 0
+            for (event, el) in et.iterparse(self.source,
+                                            events=("start", "end"),
+                                            **self.iterparse_kwargs):
+                if event == "start":
+                    if depth:
+                        depth += 1
+                        continue
+                    if not frames:
+                        self.root = el
+                        for node in reversed(self._get_front_nodes()):
+                            self._write(xf, self._transform_node(node))
+                    if el.tag in record_tags:
+                        depth = 1
+                    else:
+                        frames.append(el)
+                    continue
+                if depth > 1:
+                    depth -= 1
+                    continue
+                if depth:
+                    depth = 0
+                    self._open_frames(xf, frames, contexts, el)
+                    self._write(xf, self._transform_subtree(el))
+                    self._set_written(el)
+                    continue
+                frames.pop()
+                if len(contexts) > len(frames):
+                    # el contains records
+                    self._flush(xf, el)
+                    contexts.pop().__exit__(None, None, None)
+                    self._set_written(el)
+                elif not frames:
+                    # the root element does not contain any records
+                    self._write(xf, self._transform_subtree(el))
+        self._written = set()
+
+    @classmethod
+    def _transform_file(cls, path, output_path=None, **kwargs):
+        """Transform the file ``path`` (see ``transform_many``)"""
+        if output_path is None:
+            sink = BytesIO()
+            cls(path, **kwargs).transform(sink)
+            return sink.getvalue().decode("UTF-8")
+        cls(path, **kwargs).transform(output_path)
+        return output_path
+
+    def _transform_subtree(self, element):
+        """Transform ``element`` (a record or an element outside of
+        the records which does not contain records) like a document
+        """
+        self.input_doc = element.getroottree()
+        self.root = element
+        self._ids = {}
+        self.index()
+        ret = self._transform_node(element)
+        self._cleanup_namespaces(ret)
+        return ret
+
+    def _open_frames(self, xf, frames, contexts, child):
+        """Write the start tags of the ``frames`` not written yet and
+        their content before ``child``
+        """
+        for i in range(len(contexts), len(frames)):
+            if i:
+                self._flush(xf, frames[i - 1], frames[i])
+            frame = frames[i]
+            target = self._create_target_element(frame)
+            self._transform_attributes(frame, target)
+            context = xf.element(target.tag, dict(target.attrib),
+                                 nsmap=target.nsmap)
+            context.__enter__()
+            contexts.append(context)
+            self._write(xf, self._transform_node(TextNode(frame.text, frame)))
+        if frames:
+            self._flush(xf, frames[-1], child)
+
+    def _flush(self, xf, frame, child=None):
+        """Write the children of ``frame`` before ``child`` (all, if
+        ``child`` is None) and remove them from the input tree
+        """
+        for node in list(frame):
+            if node is child:
+                break
+            if node in self._written:
+                self._written.discard(node)
+            elif isinstance(node.tag, (str, unitext)):
+                self._write(xf, self._transform_subtree(node))
+            else:
+                self._write(xf, self._transform_node(node))
+            self._write(xf, self._transform_node(
+                TextNode(node.tail, frame, node)))
+            frame.remove(node)
+
+    def _set_written(self, element):
+        """Free ``element``, but keep its tail for ``_flush``"""
+        element.clear(keep_tail=True)
+        self._written.add(element)
+
+    def _write(self, xf, stuff):
+        """Write result of a transformation"""
+        if stuff is None:
+            return
+        if isinstance(stuff, list):
+            for item in stuff:
+                self._write(xf, item)
+        elif isinstance(stuff, (str, unitext, et._Element)):
+            xf.write(stuff)
+        else:
+            xf.write(unitext(stuff))
+
+def _qualify_name(name):
+    """Return ``name`` in Clark notation if it has a prefix from ``ns``"""
+    if name.startswith("{") or not ":" in name:
+        return name
+    prefix, local = name.split(":", 1)
+    try:
+        return "{%s}%s" % (ns[prefix], local)
+    except KeyError:
+        raise TransformerError(u"Unknown namespace prefix: %s" % prefix)
+
+def _get_output_paths(paths, output_dir):
+    """Get the paths in ``output_dir`` for the files in ``paths``
+
+    The paths relative to the directory containing all the files are
+    kept, so that files with the same name in different directories
+    do not overwrite each other.
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    if not paths:
+        return []
+    common = os.path.commonprefix([os.path.dirname(path).split(os.sep)
+                                   for path in paths])
+    root = os.sep.join(common) or os.sep
+    return [os.path.join(output_dir, os.path.relpath(path, root))
+            for path in paths]
+
+def _transform_files(cls, jobs, kwargs):
+    """Transform files with ``cls`` in a worker of ``transform_many``
+
+    ``jobs`` are pairs of the path of the input file and the path of
+    the output file (or ``None``).
+    """
+    ret = []
+    for (path, output_path) in jobs:
+        try:
+            ret.append((path, cls._transform_file(path, output_path,
+                                                  **kwargs), None))
+        except Exception:
+            ret.append((path, None, traceback.format_exc()))
+    return ret
+
 class Indenter(object):
     """
     Indenter for xml files.
@@ -901,46 +2702,77 @@ def get_text(el, skip_els=[], repl=[]):
     - ``skip_els``: list of tags to skip
       If you specify ``"*"`` then all tags will be skipped.
     - ``repl``: list of replacement strings for skipped tags
+
+    Instead of ``skip_els`` and ``repl`` you can pass a ``SkipSpec``.
     """
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
-    if not isinstance(repl, (list, tuple)):
-        repl = [repl]
-    while len(repl) < len(skip_els):
-        repl.append("")
-    ret = []
-    ret.append(el.text or "")
-    for subel in el.getchildren():
-        if not subel.tag in skip_els and not b_skip_all and \
-           not subel.tag == et.ProcessingInstruction and \
-           not subel.tag == et.Comment:
-            ret.append(get_text(subel, skip_els, repl))
+    spec = get_skip_spec(skip_els, repl)
+    if spec.empty and isinstance(el.tag, (str, unitext)):
+        return "".join(el.itertext())
+    ignores = spec.ignores
+    ret = [el.text or ""]
+    # stack of (element, iterator over its remaining children)
+    stack = [(el, iter(el))]
+    while stack:
+        for subel in stack[-1][1]:
+            if ignores(subel):
+                ret.append(spec.replacement(subel))
+            else:
+                ret.append(subel.text or "")
+                stack.append((subel, iter(subel)))
+                break
+            ret.append(subel.tail or "")
         else:
-            if b_skip_all:
-                ret.append(repl[0])
-            elif subel.tag != et.ProcessingInstruction and \
-               subel.tag != et.Comment:
-                ret.append(repl[skip_els.index(subel.tag)])
-        ret.append(subel.tail or "")
-    ret = "".join(ret)
-    return ret
+            subel = stack.pop()[0]
+            if stack:
+                ret.append(subel.tail or "")
+    return "".join(ret)
+
+def get_text_range(el, start, end=None, skip_els=[], index=None):
+    """
+    Return text content between the offsets ``start`` and ``end``
+
+    This is the same as ``get_text(el, skip_els)[start:end]``, but
+    stops at ``end`` and does not build the text before ``start``.
+    If ``end`` is ``None``, the text up to the end is returned.
 
-def goto(el, pos, skip_els=[]):
+    If you pass a ``TextOffsetIndex`` built for ``el`` as ``index``,
+    only the text segments within the range are read.
+    """
+    if isinstance(index, TextOffsetIndex):
+        _check_index(index, el)
+        return index.get_text_range(start, end)
+    if start < 0 or (end is not None and end < 0):
+        raise XMLHelperError("Negative offsets are not supported.")
+    ret = []
+    count = 0
+    for (subel, text_or_tail, txt) in get_t_struct(el, skip_els):
+        if end is not None and count >= end:
+            break
+        length = len(txt)
+        if count + length > start:
+            if end is None:
+                ret.append(txt[max(start - count, 0):])
+            else:
+                ret.append(txt[max(start - count, 0):end - count])
+        count += length
+    return "".join(ret)
+
+def goto(el, pos, skip_els=[], index=None):
     """
     Goto to character position within element
     
     Return tuple: (subelement, text_or_tail, pos)
     If positioning is not possible, the return value will be:
     (None, None, number of available characters in ``el``).
+
+    If you pass a ``TextOffsetIndex`` built for ``el`` as ``index``,
+    the position is looked up in the index (and ``skip_els`` is
+    ignored in favour of the index's own). Other indexes (like a
+    ``DocumentOrderIndex``) are not used for the lookup.
     """
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
+    if isinstance(index, TextOffsetIndex):
+        _check_index(index, el)
+        return index.goto(pos)
     # txt = get_text(el, skip_els)
     # First step: Build a document structure.
     # t_struct = [(el, text_or_tail, txt), ...]
@@ -950,8 +2782,7 @@ def goto(el, pos, skip_els=[]):
     realcnt = -1
     waitforit = None
     if pos == 0:
-        # waitforit = (t_struct[0][0], TEXT, 0)
-        waitforit = (next(t_struct)[0], TEXT, 0)
+        waitforit = (el, TEXT, 0)
     for t in t_struct:
         length = len(t[2])
         if length > 0:
@@ -966,36 +2797,145 @@ def goto(el, pos, skip_els=[]):
     else:
         return (None, None, realcnt + 1)
 
+def _check_index(index, el):
+    """Make sure ``index`` was built for ``el``"""
+    if index.element is not el:
+        raise XMLHelperError("Index built for <%s>, not for <%s>." %
+                             (index.element.tag, el.tag))
+
+def get_skip_spec(skip_els, repl=[]):
+    """Return ``skip_els`` (and ``repl``) compiled to a ``SkipSpec``
+
+    If ``skip_els`` already is a ``SkipSpec``, it is returned as is
+    (and ``repl`` is ignored in favour of its own replacements).
+    """
+    if isinstance(skip_els, SkipSpec):
+        return skip_els
+    return SkipSpec(skip_els, repl)
+
+def _predecessor(el):
+    """Return ``(el, text_or_tail)`` of the text right before ``el``"""
+    prv = el.getprevious()
+    if prv is None:
+        return (el.getparent(), TEXT)
+    return (prv, TAIL)
+
 def get_t_struct(el, skip_els=[]):
     """Generate list of text parts contained in ``el`` in document order.
 
     Yield:
         [(el, text_or_tail, txt), ...]
     """
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
-    txt = el.text or ""
-    t_struct = [(el, TEXT, txt)]
-    yield (el, TEXT, txt)
-    for subel in el:
-        if (not subel.tag in skip_els and not b_skip_all and
-           not subel.tag == et.ProcessingInstruction and
-           not subel.tag == et.Comment):
-            for ts in get_t_struct(subel, skip_els):
+    ignores = get_skip_spec(skip_els).ignores
+    yield (el, TEXT, el.text or "")
+    # stack of (element, iterator over its remaining children)
+    stack = [(el, iter(el))]
+    while stack:
+        for subel in stack[-1][1]:
+            if not ignores(subel):
+                yield (subel, TEXT, subel.text or "")
+                stack.append((subel, iter(subel)))
+                break
+            yield (subel, TAIL, subel.tail or "")
+        else:
+            subel = stack.pop()[0]
+            if stack:
+                yield (subel, TAIL, subel.tail or "")
+
+def iter_text_segments(source, container_tag, skip_els=[], **kwargs):
+    """Generate the text parts of the ``container_tag`` elements in
+    a file without parsing the whole file into memory
+
+    ``source`` is a file name or file object; it is parsed with
+    ``lxml.etree.iterparse`` (further keyword arguments are passed on
+    to it). For every element with the tag ``container_tag`` (or one
+    of the tags, if it is a list) the same text parts as from
+    ``get_t_struct`` are generated, but instead of the elements their
+    XPaths are given (the same as from ``get_xpath`` for the
+    completely parsed document). So every container starts with its
+    own ``TEXT`` part, and all its parts have its XPath as prefix.
+    Containers within containers are part of the outer container.
+
+    Processed elements are removed from the tree, so only the current
+    container and its ancestors are kept in memory.
+
+    Yield:
+        [(xpath, text_or_tail, txt), ...]
+    """
+    if not isinstance(container_tag, (list, tuple, set, frozenset)):
+        container_tag = [container_tag]
+    container_tags = frozenset(container_tag)
+    ignores = get_skip_spec(skip_els).ignores
+    # (xpath, {tag: number of children so far}) of the open elements
+    # outside of the containers
+    stack = []
+    # depth within the current container (0: not within a container)
+    depth = 0
+    for (event, el) in et.iterparse(source, events=("start", "end"),
+                                    **kwargs):
+        if event == "start":
+            if depth:
+                depth += 1
+                continue
+            tag = el.tag
+            if stack:
+                path, counts = stack[-1]
+                counts[tag] = counts.get(tag, 0) + 1
+                path = "%s/%s[%d]" % (path, tag, counts[tag])
+            else:
+                path = "/%s[1]" % tag
+            stack.append((path, {}))
+            if tag in container_tags:
+                depth = 1
+            continue
+        if depth > 1:
+            depth -= 1
+            continue
+        path = stack.pop()[0]
+        if depth:
+            depth = 0
+            for ts in _iter_path_t_struct(el, path, ignores):
                 yield ts
-        tail = subel.tail or ""
-        yield (subel, TAIL, tail)
+        el.clear()
+        # all previous siblings have been processed, too
+        parent = el.getparent()
+        if parent is not None:
+            while el.getprevious() is not None:
+                del parent[0]
+
+def _iter_path_t_struct(el, path, ignores):
+    """``get_t_struct`` with XPaths (``el`` having ``path``)"""
+    yield (path, TEXT, el.text or "")
+    # stack of (element, xpath, {tag: number of children so far},
+    # iterator over its remaining children)
+    stack = [(el, path, {}, iter(el))]
+    while stack:
+        (parent, parent_path, counts, children) = stack[-1]
+        for subel in children:
+            tag = subel.tag
+            counts[tag] = counts.get(tag, 0) + 1
+            path = "%s/%s[%d]" % (parent_path, tag, counts[tag])
+            if not ignores(subel):
+                yield (path, TEXT, subel.text or "")
+                stack.append((subel, path, {}, iter(subel)))
+                break
+            yield (path, TAIL, subel.tail or "")
+        else:
+            stack.pop()
+            if stack:
+                yield (parent_path, TAIL, parent.tail or "")
 
-def delete(el):
+def delete(el, index=None):
     """
     Delete element without losing its tail
+
+    If given, the ``TextOffsetIndex`` ``index`` is updated.
     """
     parent = el.getparent()
     if parent == None:
         raise XMLHelperError("Cannot delete root element.")
+    if index is not None:
+        pred = _predecessor(el)
     if el.tail:
         pos = parent.index(el)
         if pos==0:
@@ -1004,29 +2944,124 @@ def delete(el):
             append_to = parent[pos - 1]
             append_to.tail = "%s%s" % ((append_to.tail or ""), el.tail)
     parent.remove(el)
+    if index is not None:
+        index.removed(el)
+        index.changed(*pred)
 
-def insert_at(el, new_el, pos, skip_els=[]):
+def insert_at(el, new_el, pos, skip_els=[], index=None):
     """
     Inserts element ``new_el`` at text position ``pos``.
 
     With ``skip_els`` you can specify which elements to skip
-    while counting letters.
+    while counting letters. With ``index`` you can pass a
+    ``TextOffsetIndex`` for ``el`` to look up the position
+    (the index will be updated) or a ``DocumentOrderIndex`` to be
+    updated.
 
     Returns newly inserted element.
     """
-    subelement, text_or_tail, subpos = goto(el, pos, skip_els)
+    subelement, text_or_tail, subpos = goto(el, pos, skip_els, index)
     if subelement is None:
         raise XMLHelperError("Cannot go to pos %d in element <%s>." %
                              (pos, el.tag))
     if text_or_tail == TEXT:
-        return insert_into_text(subelement, new_el, subpos)
+        return insert_into_text(subelement, new_el, subpos, index)
     elif text_or_tail == TAIL:
-        return insert_into_tail(subelement, new_el, subpos)
+        return insert_into_tail(subelement, new_el, subpos, index)
+
+def insert_many_at(el, inserts, skip_els=[], index=None):
+    """
+    Insert many elements at many text positions in one pass.
+
+    ``inserts`` is a list of ``(pos, new_el)`` tuples. All positions
+    refer to the text of ``el`` before any insertion, i. e. the result
+    is the same as calling ``insert_at`` in descending order of
+    positions. Elements sharing a position are inserted in the
+    given order.
 
-def insert_into_text(el, new_el, pos):
+    If given, the ``TextOffsetIndex`` ``index`` is updated.
+
+    Returns list of the newly inserted elements.
+    """
+    todo = sorted(inserts, key=lambda x: x[0])
+    if len(todo) == 0:
+        return []
+    if todo[0][0] < 0:
+        raise XMLHelperError("Cannot go to pos %d in element <%s>." %
+                             (todo[0][0], el.tag))
+    # First step: find the segments the positions fall in.
+    # groups = [(subel, text_or_tail, [(subpos, new_el), ...]), ...]
+    groups = []
+    last = None
+    count = 0
+    i = 0
+    for (subel, text_or_tail, txt) in get_t_struct(el, skip_els):
+        length = len(txt)
+        if length == 0:
+            continue
+        end = count + length
+        if todo[i][0] < end:
+            group = []
+            groups.append((subel, text_or_tail, group))
+            while i < len(todo) and todo[i][0] < end:
+                group.append((todo[i][0] - count, todo[i][1]))
+                i += 1
+        last = (subel, text_or_tail, length)
+        count = end
+        if i == len(todo):
+            break
+    if i < len(todo):
+        # The remaining positions are at (or beyond) the end.
+        if todo[-1][0] > count:
+            raise XMLHelperError("Cannot go to pos %d in element <%s>." %
+                                 (todo[-1][0], el.tag))
+        if last is None:
+            last = (el, TEXT, 0)
+        if len(groups) > 0 and groups[-1][0] is last[0] and \
+                groups[-1][1] == last[1]:
+            group = groups[-1][2]
+        else:
+            group = []
+            groups.append((last[0], last[1], group))
+        group.extend((last[2], new_el) for (pos, new_el) in todo[i:])
+    # Second step: split every segment once.
+    for (subel, text_or_tail, group) in groups:
+        if text_or_tail == TEXT:
+            txt = subel.text
+        else:
+            txt = subel.tail
+        positions = [subpos for (subpos, new_el) in group[1:]]
+        positions.append(None)
+        if txt:
+            head = txt[0:group[0][0]]
+            if text_or_tail == TEXT:
+                subel.text = head
+            else:
+                subel.tail = head
+        previous = subel
+        for (j, (subpos, new_el)) in enumerate(group):
+            rest = txt[subpos:positions[j]] if txt else ""
+            if new_el.tail:
+                new_el.tail = "%s%s" % (new_el.tail, rest)
+            else:
+                new_el.tail = rest
+            if text_or_tail == TEXT:
+                subel.insert(j, new_el)
+            else:
+                previous.addnext(new_el)
+                previous = new_el
+        if index is not None:
+            index.changed(subel, text_or_tail)
+            for (subpos, new_el) in group:
+                index.inserted(new_el)
+    return [new_el for (pos, new_el) in inserts]
+
+def insert_into_text(el, new_el, pos, index=None):
     """
     Insert ``new_el`` into text of element ``el`` at ``pos``
 
+    If given, the ``TextOffsetIndex`` ``index`` is updated.
+
     Returns new_el
     """
     if el.text:
@@ -1038,12 +3073,17 @@ def insert_into_text(el, new_el, pos):
     else:
         new_el.tail = rest
     el.insert(0, new_el)
+    if index is not None:
+        index.changed(el, TEXT)
+        index.inserted(new_el)
     return new_el
 
-def insert_into_tail(el, new_el, pos):
+def insert_into_tail(el, new_el, pos, index=None):
     """
     Insert ``new_el`` into tail of element ``el`` at ``pos``
 
+    If given, the ``TextOffsetIndex`` ``index`` is updated.
+
     Returns new_el
     """
     if el.tail:
@@ -1054,9 +3094,10 @@ def insert_into_tail(el, new_el, pos):
         new_el.tail = "%s%s" % (new_el.tail, rest)
     else:
         new_el.tail = rest
-    parent = el.getparent()
-    idx = parent.getchildren().index(el)
-    parent.insert(idx + 1, new_el)
+    el.addnext(new_el)
+    if index is not None:
+        index.changed(el, TAIL)
+        index.inserted(new_el)
     return new_el
 
 def goto_next_char(el, text_or_tail, pos, container, skip_els=[]):
@@ -1064,12 +3105,8 @@ def goto_next_char(el, text_or_tail, pos, container, skip_els=[]):
     Move ahead until we find a real character
     (or are at the end of container)
     """
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
-    if not container in el.xpath("ancestor-or-self::*"):
+    skip_els = get_skip_spec(skip_els)
+    if el is not container and not contains(container, el):
         raise XMLHelperError("Element <%s> not in container <%s>." %\
                               (el.tag, container.tag))
     if text_or_tail == TEXT:
@@ -1079,7 +3116,7 @@ def goto_next_char(el, text_or_tail, pos, container, skip_els=[]):
         # the trivial case did not work
         if len(el) > 0:
             subel = el.getchildren()[0]
-            if not b_skip_all and not subel.tag in skip_els:
+            if not skip_els.matches(subel.tag):
                 newel, newtext_or_tail = goto_next_char(subel, TEXT, 0,
                                                         subel, skip_els)
                 if not newel is None:
@@ -1108,7 +3145,7 @@ def goto_next_char(el, text_or_tail, pos, container, skip_els=[]):
     idx = parent.index(el)
     if idx + 1 < len(parent):
         nextel = parent[idx + 1]
-        if b_skip_all or nextel.tag in skip_els:
+        if skip_els.matches(nextel.tag):
             newel, newtext_or_tail = goto_next_char(nextel, TAIL, 0,
                                                     parent, skip_els)
         else:
@@ -1130,28 +3167,36 @@ def count_characters(el, skip_els=[]):
     """
     Count characters in an element
     """
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
+    spec = get_skip_spec(skip_els)
+    if spec.empty and isinstance(el.tag, (str, unitext)):
+        return sum(len(txt) for txt in el.itertext())
+    ignores = spec.ignores
     count = 0
     if el.text:
         count = len(el.text)
-    for subel in el.getchildren():
-        if not b_skip_all and not subel.tag in skip_els and \
-           not subel.tag == et.ProcessingInstruction and\
-           not subel.tag == et.Comment:
-            count += count_characters(subel, skip_els)
-        if subel.tail:
-            count += len(subel.tail)
+    # the order does not matter here, so a plain stack of elements
+    # whose children still have to be counted will do
+    stack = [el]
+    while stack:
+        for subel in stack.pop():
+            if not ignores(subel):
+                if subel.text:
+                    count += len(subel.text)
+                stack.append(subel)
+            if subel.tail:
+                count += len(subel.tail)
     return count
 
-def remove_tags(el):
+def remove_tags(el, index=None):
     """
     Remove enclosing tags, but keep content
+
+    If given, the ``TextOffsetIndex`` ``index`` is updated.
     """
     parent = el.getparent()
+    if index is not None:
+        pred = _predecessor(el)
+        children = list(el)
     idx = parent.index(el)
     if idx == 0:
         txt = parent.text or ""
@@ -1170,19 +3215,25 @@ def remove_tags(el):
         tail = parent[idx - 1].tail or ""
         parent[idx - 1].tail = "%s%s" % (tail, el.tail or "")
     parent.remove(el)
+    if index is not None:
+        index.removed(el)
+        index.changed(*pred)
+        for child in children:
+            index.inserted(child)
 
-def get_pos(el, skip_els=[]):
+def get_pos(el, skip_els=[], index=None):
     """
     Get position of element in the text of the parent element
+
+    If ``index`` is given, the position is looked up in this
+    ``TextOffsetIndex`` (which must contain ``el`` and its parent).
     """
+    if isinstance(index, TextOffsetIndex):
+        return index.get_pos(el)
     parent = el.getparent()
     if parent is None:
         raise XMLHelperError("Element %s has no parent." % el.tag)
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
+    skip_els = get_skip_spec(skip_els)
     idx = parent.index(el)
     if idx == 0:
         if parent.text:
@@ -1194,44 +3245,75 @@ def get_pos(el, skip_els=[]):
     else:
         pos = 0
     for subel in parent[0:idx]:
-        if (not b_skip_all) and (not subel.tag in skip_els):
-            pos += len(get_text(subel, skip_els))
+        if not skip_els.ignores(subel):
+            pos += count_characters(subel, skip_els)
         if subel.tail:
             pos += len(subel.tail)
     return pos
 
 def cut(from_el, to_el):
-    """Cut passages of document"""
-    # @@@TODO: There are too many calls to xpaths
-    folls = from_el.xpath("following::*")
-    if not to_el in folls:
+    """Cut passages of document
+
+    Everything between ``from_el`` and ``to_el`` (in document order)
+    is removed together with these two elements. Elements that
+    contain only one of them are kept (i. e. the document stays well
+    formed), just their content between the two is removed.
+    Comments and processing instructions are kept.
+    """
+    # ancestors of to_el must not be removed
+    to_ancestors = set()
+    parent = to_el.getparent()
+    while parent is not None:
+        to_ancestors.add(parent)
+        parent = parent.getparent()
+    # all elements between from_el and to_el in document order
+    between = []
+    for el in FollowingIterator(from_el):
+        if el is to_el:
+            break
+        if isinstance(el.tag, (str, unitext)):
+            between.append(el)
+    else:
         raise XMLHelperError("Element ``from_el`` (%s) not before "\
                 "element ``to_el`` (%s) in document order." %\
                 (from_el.tag, to_el.tag))
     from_el.tail = None
-    for el in folls:
-        if el == to_el:
-            break
-        if to_el in el.xpath("descendant::*"):
+    removed = set()
+    for el in between:
+        if el in to_ancestors:
             el.text = None
+            continue
+        removed.add(el)
+        if el.getparent() in removed:
+            # gone with its parent
+            continue
+        # Remove el (and thus all its descendants), but keep
+        # comments, processing instructions, and entities.
+        # Text around them is emptied, i. e. set to "" (not None).
+        prv = el.getprevious()
+        if prv is None:
+            el.getparent().text = el.getparent().text or ""
         else:
-            el.text = None
-            el.tail = None
-            remove_tags(el)
-    for el in from_el.xpath("ancestor::*"):
-        if not to_el in el.xpath("descendant::*"):
-            el.tail = None
+            prv.tail = prv.tail or ""
+        for node in list(el.iter(et.Comment, et.PI, et.Entity)):
+            nxt = node.getnext()
+            if nxt is None or isinstance(nxt.tag, (str, unitext)):
+                node.tail = node.tail or ""
+            el.addprevious(node)
+        el.tail = None
+        el.getparent().remove(el)
+    parent = from_el.getparent()
+    while parent is not None:
+        if not parent in to_ancestors:
+            parent.tail = None
+        parent = parent.getparent()
     delete(from_el)
     delete(to_el)
     return
 
 def rstrip(el, skip_els=[]):
     """rstrip a given element"""
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
+    skip_els = get_skip_spec(skip_els).without_replacements()
     txt = get_text(el, skip_els)
     if txt != txt.rstrip():
         # first deal with children
@@ -1241,8 +3323,7 @@ def rstrip(el, skip_els=[]):
             sibling = children[current_index]
             sibling.tail = (sibling.tail or "").rstrip()
             if sibling.tail == "":
-                if not sibling.tag in skip_els and \
-                        not b_skip_all:
+                if not skip_els.matches(sibling.tag):
                     sibling = rstrip(sibling)
                     if get_text(sibling) == "":
                         current_index -= 1
@@ -1263,11 +3344,7 @@ def rstrip(el, skip_els=[]):
 
 def lstrip(el, skip_els=[]):
     """lstrip a given element"""
-    b_skip_all = False
-    if skip_els == "*":
-        b_skip_all = True
-    elif not isinstance(skip_els, (list, tuple)):
-        skip_els = [skip_els]
+    skip_els = get_skip_spec(skip_els).without_replacements()
     if (el.text or ""):
         el.text = el.text.lstrip()
     if len(el) == 0:
@@ -1275,7 +3352,7 @@ def lstrip(el, skip_els=[]):
     if (el.text or "") == "":
         # OK, we need to go on with the children
         for subel in el:
-            if not (subel.tag in skip_els or b_skip_all):
+            if not skip_els.matches(subel.tag):
                 lstrip(subel)
                 txt = get_text(subel, skip_els)
             else:
@@ -1297,7 +3374,7 @@ def strip(el, skip_els=[]):
     rstrip(el, skip_els)
     return el
 
-def move_element(src, target):
+def move_element(src, target, index=None):
     """
     Move complete element ``src`` with all content to ``target``
     
@@ -1305,9 +3382,11 @@ def move_element(src, target):
     The source element will be removed. The target element will
     be renamed accordingly. Any present attributes and subelements
     will be deleted.
+
+    If given, the ``TextOffsetIndex`` ``index`` is updated.
     """
     # sanity check
-    if src in target.xpath("ancestor-or-self::*"):
+    if target is src or contains(src, target):
         raise XMLHelperError("Target <%s> contained in source <%s>." %\
                              (target.tag, src.tag))
     # clean target
@@ -1325,9 +3404,15 @@ def move_element(src, target):
     for att in src.attrib:
         target.set(att, src.get(att))
     # remove src
+    if index is not None:
+        pred = _predecessor(src)
     delete(src)
+    if index is not None:
+        index.removed(src)
+        index.changed(*pred)
+        index.inserted(target)
 
-def move_element_to_pos(src, target, text_or_tail, pos):
+def move_element_to_pos(src, target, text_or_tail, pos, index=None):
     """
     Move element ``src`` to the given target position.
     
@@ -1337,30 +3422,35 @@ def move_element_to_pos(src, target, text_or_tail, pos):
     # create target element
     new_el = et.Element("target")
     if text_or_tail == TEXT:
-        insert_into_text(target, new_el, pos)
+        insert_into_text(target, new_el, pos, index)
     else:
-        insert_into_tail(target, new_el, pos)
+        insert_into_tail(target, new_el, pos, index)
     # move source to target with ``move_element``
-    move_element(src, new_el)
+    move_element(src, new_el, index)
     return new_el
 
-def move_element_to_textpos(src, target, textpos, skip_els=[]):
+def move_element_to_textpos(src, target, textpos, skip_els=[], index=None):
     """
     Move ``src`` to ``textpos`` in ``target``.
     
     Return newly created element (as it will effectively
     be a copy of ``src``).
+
+    If given, the ``TextOffsetIndex`` or ``DocumentOrderIndex``
+    ``index`` is updated (see ``insert_at``).
     """
     # create target element
     new_el = et.Element("target")
-    insert_at(target, new_el, textpos, skip_els)
+    insert_at(target, new_el, textpos, skip_els, index)
     # move
-    move_element(src, new_el)
+    move_element(src, new_el, index)
     return new_el
 
-def wrap(new_el, target):
+def wrap(new_el, target, index=None):
     """
     Wrap given new element ``new_el`` around ``target``
+
+    If given, the ``TextOffsetIndex`` ``index`` is updated.
     """
     parent = target.getparent()
     if parent is None:
@@ -1371,6 +3461,9 @@ def wrap(new_el, target):
     new_el.append(target)
     new_el.tail = target.tail
     target.tail = None
+    if index is not None:
+        index.removed(target)
+        index.inserted(new_el)
 
 def collect(new_el, target_els):
     """
@@ -1502,10 +3595,15 @@ def get_xpath_index(el):
         elif child.tag == el.tag:
             cnt += 1
 
-def get_xpath(el):
+def get_xpath(el, namespaces=None):
     """
     Return an xpath of given ``el`` relative to document root
+
+    With ``namespaces``, the tags are written with prefixes, see
+    ``XPathLocator``.
     """
+    if namespaces is not None:
+        return XPathLocator(namespaces).get_xpath(el)
     ret = []
     parent = el.getparent()
     current_el = el
@@ -1522,6 +3620,22 @@ def get_xpath(el):
     ret.reverse()
     return "/" + "/".join(ret)
 
+def get_xpaths(nodes, namespaces=None):
+    """
+    Return list of the xpaths of all ``nodes`` (as ``get_xpath``)
+
+    The nodes should belong to the same document. See ``XPathLocator``.
+    """
+    return XPathLocator(namespaces).get_xpaths(nodes)
+
+def xpath(el, expr, namespaces=None, **variables):
+    """
+    Evaluate XPath ``expr`` on ``el`` (like ``el.xpath``)
+
+    The compiled expression is taken from ``xpath_cache``.
+    """
+    return xpath_cache.get(expr, namespaces)(el, **variables)
+
 def delat(el, attname):
     """
     Delete attribute
@@ -1531,9 +3645,12 @@ def delat(el, attname):
     except KeyError:
         pass
 
-def switch(el1, el2):
+def switch(el1, el2, index=None):
     """
     Switch places of ``el1`` and ``el2``.
+
+    If given, the ``DocumentOrderIndex`` ``index`` is used to check
+    whether the elements are nested and invalidated afterwards.
     """
     if el1 is el2:
         return
@@ -1543,7 +3660,7 @@ def switch(el1, el2):
     parent2 = el2.getparent()
     if parent2 is None:
         raise XMLHelperError("Cannot switch with root element.")
-    if contains(el1, el2) or contains(el2, el1):
+    if contains(el1, el2, index) or contains(el2, el1, index):
         raise XMLHelperError("Cannot switch nested elements.")
     pos1 = parent1.index(el1)
     pos2 = parent2.index(el2)
@@ -1555,11 +3672,21 @@ def switch(el1, el2):
     tmp = el1.tail
     el1.tail = el2.tail
     el2.tail = tmp
+    if index is not None:
+        index.invalidate()
 
-def contains(el1, el2):
+def contains(el1, el2, index=None):
     """
     Is ``el2`` descendant of ``el1``?
+
+    If given, the answer is looked up in the ``DocumentOrderIndex``
+    ``index``.
     """
+    if index is not None:
+        if not isinstance(index, DocumentOrderIndex):
+            raise XMLHelperError("``contains`` needs a DocumentOrderIndex, "
+                                 "not %s." % index.__class__.__name__)
+        return index.contains(el1, el2)
     parent = el2.getparent()
     while parent is not None:
         if parent is el1:
@@ -1567,6 +3694,126 @@ def contains(el1, el2):
         parent = parent.getparent()
     return False
 
+def find_following(el, tag=None, predicate=None, limit=None, stop_at=None):
+    """Return the first element on the following axis of ``el`` (or
+    None)
+
+    - ``tag``: tag (or list of tags) of the element, ``None`` for any
+      element (comments and processing instructions are never found)
+    - ``predicate``: function the element must satisfy
+    - ``limit``: maximum number of elements with ``tag`` to check
+    - ``stop_at``: if this is an ancestor of ``el``, only search
+      within it; else stop the search at ``stop_at`` (i. e. only
+      find elements between ``el`` and ``stop_at`` neither containing
+      nor contained in ``stop_at``)
+
+    Simple queries for a tag are answered with a compiled XPath
+    expression, the others by scanning the siblings of ``el`` and its
+    ancestors with ``iter``.
+    """
+    return _find(el, tag, predicate, limit, stop_at, False)
+
+def find_preceding(el, tag=None, predicate=None, limit=None, stop_at=None):
+    """Return the first element on the preceding axis of ``el`` (or
+    None), i. e. the nearest one before ``el`` not containing it
+
+    The arguments are the same as for ``find_following``.
+    """
+    return _find(el, tag, predicate, limit, stop_at, True)
+
+def _find(el, tag, predicate, limit, stop_at, preceding):
+    """Implement ``find_following`` and ``find_preceding``"""
+    if (predicate is None and limit is None and stop_at is None and
+            not isinstance(tag, (list, tuple, set, frozenset))):
+        ret = _get_axis_xpath(tag, preceding)(el)
+        return ret[0] if ret else None
+    if tag is None:
+        tags = (et.Element,)
+    elif isinstance(tag, (list, tuple, set, frozenset)):
+        tags = tuple(tag)
+    else:
+        tags = (tag,)
+    cnt = 0
+    for candidate in _iter_axis(el, tags, stop_at, preceding):
+        if limit is not None:
+            if cnt == limit:
+                return None
+            cnt += 1
+        if predicate is None or predicate(candidate):
+            return candidate
+    return None
+
+def _get_axis_xpath(tag, preceding):
+    """Return compiled XPath for the first element with ``tag`` on
+    the preceding or following axis
+    """
+    axis = "preceding" if preceding else "following"
+    namespaces = None
+    if tag is None or tag == "*":
+        test = "*"
+    elif tag.startswith("{"):
+        uri, local = tag[1:].split("}", 1)
+        if uri == "*":
+            test = "*[local-name() = '%s']" % local
+        elif uri:
+            test = "ns:%s" % local
+            namespaces = {"ns": uri}
+        else:
+            test = local
+    else:
+        test = tag
+    return xpath_cache.get("%s::%s[1]" % (axis, test), namespaces)
+
+def _iter_axis(el, tags, stop_at, preceding):
+    """Generate the elements with ``tags`` on the preceding or
+    following axis of ``el`` (see ``find_following``)
+    """
+    # stop_at and its ancestors (if it is not an ancestor of el)
+    boundary = set()
+    if stop_at is not None and not contains(stop_at, el):
+        node = stop_at
+        while node is not None:
+            boundary.add(node)
+            node = node.getparent()
+    node = el
+    while node is not stop_at:
+        for sibling in node.itersiblings(preceding=preceding):
+            if sibling is stop_at:
+                return
+            if sibling in boundary:
+                # the part of the sibling before (or after) stop_at
+                for ret in _iter_up_to(sibling, tags, stop_at, boundary,
+                                       preceding):
+                    yield ret
+                return
+            if preceding:
+                for ret in reversed(list(sibling.iter(*tags))):
+                    yield ret
+            else:
+                for ret in sibling.iter(*tags):
+                    yield ret
+        node = node.getparent()
+        if node is None:
+            return
+
+def _iter_up_to(element, tags, stop_at, boundary, preceding):
+    """Generate the elements with ``tags`` within ``element`` (which
+    contains ``stop_at``) between ``stop_at`` and the start (or the
+    end) of ``element``, in reverse document order if ``preceding``
+    """
+    while element is not stop_at:
+        children = reversed(element) if preceding else iter(element)
+        for child in children:
+            if child is stop_at or child in boundary:
+                element = child
+                break
+            if preceding:
+                for ret in reversed(list(child.iter(*tags))):
+                    yield ret
+            else:
+                for ret in child.iter(*tags):
+                    yield ret
+
 def strip_namespace_from_tagname(tagname):
     if tagname.startswith("{"):
         endpos = tagname.find("}")